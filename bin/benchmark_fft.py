@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""This script benchmarks the fft backends in routines.utils against
+the np.fft.rfft call that FouriorTransform used to make, on random
+data shaped like a typical TOD.
+
+Example:
+./bin/benchmark_fft.py --ndet 1000 --nsamps 200000 --workers 1 4 8
+
+With --timings, it also measures the fft time of all regular sizes in
+[nsamps, 1.05 nsamps] and stores them for the 'benchmark' policy of
+FFTSizePlanner (FouriorTransform's fft_timings parameter).
+
+It prints the best wall time of each backend / worker count and the
+maximum deviation from the reference relative to the largest fourior
+coefficient.
+"""
+
+import os, sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from routines.utils import rfft, nextregular, FFTSizePlanner
+
+################################
+# parse command-line arguments #
+################################
+
+parser = argparse.ArgumentParser(description="Benchmark the fft backends")
+parser.add_argument("--ndet", help="Number of detectors", type=int, default=1000)
+parser.add_argument("--nsamps", help="Number of samples", type=int, default=200000)
+parser.add_argument("--workers", help="Numbers of threads to try", type=int,
+                    nargs="+", default=[1, 4, 8])
+parser.add_argument("--block_size", help="Detectors per block", type=int, default=64)
+parser.add_argument("--repeat", help="Number of repetitions", type=int, default=3)
+parser.add_argument("--timings", help="Json file to store fft timings per size in", default=None)
+args = parser.parse_args()
+
+
+def timeit(func):
+    """Return the best time out of a few repetitions and the result"""
+    best = np.inf
+    for i in range(args.repeat):
+        t0 = time.time()
+        res = func()
+        best = min(best, time.time() - t0)
+    return best, res
+
+#############
+# benchmark #
+#############
+
+data = np.random.randn(args.ndet, args.nsamps).astype('float32')
+nf = nextregular(args.nsamps)
+print("Data: %d x %d float32, nf = %d" % (args.ndet, args.nsamps, nf))
+
+# the reference is computed in double precision as numpy < 2 did
+t_ref, ref = timeit(lambda: np.fft.rfft(data.astype('float64'), nf))
+print("%-35s %6.2f s" % ("numpy rfft (reference):", t_ref))
+scale = np.abs(ref).max()
+
+out = np.empty_like(ref)
+for backend in ['numpy', 'scipy']:
+    for w in (args.workers if backend == 'scipy' else [1]):
+        t, res = timeit(lambda: rfft(data, nf, out=out, workers=w, backend=backend,
+                                     block_size=args.block_size))
+        diff = np.abs(res - ref).max() / scale
+        print("%-35s %6.2f s    max rel. diff %.1e" % (
+            "%s rfft, workers=%d:" % (backend, w), t, diff))
+
+###############################
+# timings for the fft planner #
+###############################
+
+if args.timings is not None:
+    planner = FFTSizePlanner(backend='scipy')
+    planner.measure(args.nsamps, int(args.nsamps*1.05), repeat=args.repeat,
+                    workers=max(args.workers))
+    planner.save_timings(args.timings)
+    print("Timings of %d sizes saved in %s" % (len(planner.timings), args.timings))
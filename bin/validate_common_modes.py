@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""This script checks the common mode methods of routines.utils against
+the full svd of the correlation matrix that the drift, MF and HF analyses
+used to make, on random data shaped like a band of the spectrum: nmodes
+common modes with random detector gains on top of white noise.
+
+Example:
+./bin/validate_common_modes.py --ndet 1000 --nfreq 6000 --nmodes 1 3 10
+
+For each method it prints the best wall time of deproject_modes and the
+maximum deviation of the deprojected data from the svd reference,
+relative to the largest deprojected coefficient. The subspace method is
+run twice, the second run is seeded with the first. The script exits
+with status 1 if a method deviates by more than the tolerance.
+"""
+
+import os, sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from routines.utils import deproject_modes, CommonModeSolver
+
+################################
+# parse command-line arguments #
+################################
+
+parser = argparse.ArgumentParser(description="Validate the common mode methods")
+parser.add_argument("--ndet", help="Number of detectors", type=int, default=1000)
+parser.add_argument("--nfreq", help="Number of frequencies", type=int, default=6000)
+parser.add_argument("--nmodes", help="Numbers of modes to try", type=int,
+                    nargs="+", default=[1, 3, 10])
+parser.add_argument("--snr", help="Amplitude of the common modes relative to "
+                    "the noise", type=float, default=10.)
+parser.add_argument("--dtype", help="Data type of the band", default="complex128")
+parser.add_argument("--tolerance", help="Largest relative deviation allowed",
+                    type=float, default=1e-6)
+parser.add_argument("--repeat", help="Number of repetitions", type=int, default=3)
+parser.add_argument("--seed", help="Seed of the random data", type=int, default=0)
+args = parser.parse_args()
+
+
+def timeit(func):
+    """Return the best time out of a few repetitions and the result"""
+    best = np.inf
+    for i in range(args.repeat):
+        t0 = time.time()
+        res = func()
+        best = min(best, time.time() - t0)
+    return best, res
+
+
+def make_band(nmodes):
+    """Random band with nmodes common modes of decreasing amplitude"""
+    rng = np.random.RandomState(args.seed)
+    shape = (args.ndet, args.nfreq)
+    data = rng.randn(*shape) + 1j*rng.randn(*shape)
+    modes = rng.randn(nmodes, args.nfreq) + 1j*rng.randn(nmodes, args.nfreq)
+    gains = rng.randn(args.ndet, nmodes) * args.snr / (1. + np.arange(nmodes))
+    data += np.dot(gains, modes)
+    return data.astype(args.dtype)
+
+############
+# validate #
+############
+
+print("Data: %d x %d %s, snr %.1f" % (args.ndet, args.nfreq, args.dtype, args.snr))
+failed = False
+for nmodes in args.nmodes:
+    band = make_band(nmodes)
+    t_ref, ref = timeit(lambda: deproject_modes(band.copy(), nmodes, method='svd',
+                                                dtype='complex128'))
+    scale = np.abs(ref).max()
+    print("nmodes = %d" % nmodes)
+    print("  %-25s %7.3f s" % ("svd (reference):", t_ref))
+
+    solver = CommonModeSolver()
+    CommonModeSolver.clear()
+    runs = [('eigh', {}), ('randomized', {}),
+            ('subspace', {'solver': solver, 'key': 'validate'}),
+            ('subspace (seeded)', {'solver': solver, 'key': 'validate'})]
+    for name, kwargs in runs:
+        method = name.split()[0]
+        repeat = 1 if method == 'subspace' else args.repeat
+        t = np.inf
+        for i in range(repeat):
+            t0 = time.time()
+            res = deproject_modes(band.copy(), nmodes, method=method,
+                                  dtype='complex128', **kwargs)
+            t = min(t, time.time() - t0)
+        diff = np.abs(res - ref).max() / scale
+        ok = diff <= args.tolerance
+        failed = failed or not ok
+        extra = ""
+        if method == 'subspace':
+            extra = "  (%(niter)d iterations, fallback %(fallback)s)" % solver.info
+        print("  %-25s %7.3f s    max rel. diff %.1e %s%s" % (
+            name + ":", t, diff, "ok" if ok else "FAILED", extra))
+
+sys.exit(1 if failed else 0)
@@ -1,11 +1,11 @@
 from __future__ import division
 
 import numpy as np
-from numpy import ma
 import scipy.stats.mstats as ms
 from scipy import stats as stat
 from scipy.cluster.vq import kmeans2
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import moby2
 from todloop import Routine
@@ -23,10 +23,16 @@ class AnalyzeScan(Routine):
             tod: TOD data
         Outputs:
             scan_params: 
-                T: time per chunk
-                pivot: index of pivot
-                N: number of chunks
+                T: length of the shortest swing
+                pivot: index of the first turnaround
+                N: number of swings
+                swings: [start, end) sample ranges of the swings, the
+                    part of each sweep between two consecutive
+                    turnarounds that moves at the scan speed
+                turnarounds: indices of the scan turnarounds
                 scan_freq: scan frequency
+
+        All indices are in samples of the (downsampled) TOD.
         """
         Routine.__init__(self)
         self.inputs = params.get('inputs', None)
@@ -49,22 +55,24 @@ class AnalyzeScan(Routine):
         # get scan frequency
         scan_freq = scan["scan_freq"]
 
-        # get downsample level
-        ds = tod.info.downsample_level
-
-        # summary of scan parameters
+        # summary of scan parameters, the chunks are in samples of the
+        # TOD as it is, to be compared with tod.nsamps
         scan_params = {
-            # 'T': scan["T"] * ds,
-            # 'pivot': scan["pivot"] * ds,
-            # 'N': scan["N"],
+            'T': scan["T"],
+            'pivot': scan["pivot"],
+            'N': scan["N"],
+            'swings': scan["swings"],
+            'turnarounds': scan["turnarounds"],
             'scan_freq': scan_freq
         }
         
         self.logger.debug(scan_params)
         store.set(self.outputs.get('scan'), scan_params)
 
-    def analyze_scan(self, az, dt=0.002508, N=50, vlim=0.01, qlim=0.01):
-        """Find scan parameters and cuts"""
+    def analyze_scan(self, az, dt=0.002508, N=50, vlim=0.01, qlim=0.01,
+                     vswing=0.9):
+        """Find scan parameters and cuts, the swings are where the
+        smoothed scan speed is above vswing times the median speed"""
 
         # Find no motion
 
@@ -111,7 +119,9 @@ class AnalyzeScan(Routine):
                 "az_cuts": None,
                 "T": len(az),
                 "pivot": 0,
-                "N": 1
+                "N": 1,
+                "swings": np.array([[0, len(az)]]),
+                "turnarounds": np.array([], dtype=int)
             }
             return scan
 
@@ -127,38 +137,35 @@ class AnalyzeScan(Routine):
         # scan frequency
         fscan = np.where(abs(faz) == abs(faz).max())[0][0] / dt / len(az)
 
-        # temporily remove this part
-        # # Find turnarounds
-        # az_min = np.median(az[stop * (az < lo)])
-        # az_max = np.median(az[stop * (az > hi)])
-        # # i don't understand this part
-        # td = abs(lo - az_min) + abs(az_max - hi)
-
-        # # Find scan period parameters
-        # T_scan = int(1. / fscan / dt)  # number of samples in scan period
-
-        # # this is kind of arbitrary
-        # T_ex = int(1.2 * T_scan)
-
-        # # find non-stopping part of scan
-        # onescan = az[~noscan][:T_ex]
-        # az_min0 = np.min(onescan[stop[~noscan][:T_ex] * (onescan < lo)
-        #                          * (onescan > lo - td)])
-        # az_max0 = np.max(onescan[stop[~noscan][:T_ex] * (onescan > hi)
-        #                          * (onescan < hi + td)])
-        # imin0 = np.where(az == az_min0)[0][0]
-        # imax0 = np.where(az == az_max0)[0][0]
-        # pivot = np.min([imin0, imax0])  # Index of first scan minima or maxima
-        # N_scan = (len(az) - pivot) / T_scan  # Number of complete scan periods
-
-        # # Find cuts
-        # if hi - lo < 1. * np.pi / 180:
-        #     flag = np.ones_like(az, dtype=bool)
-        # else:
-        #     flag = (pick + stop) * (az > lo) * (az < hi) + (az < lo - td) + (
-        #         az > hi + td)
-
-        # c_vect = moby2.tod.cuts.CutsVector.from_mask(flag).get_buffered(100)
+        # Find turnarounds as the sign changes of the smoothed scan
+        # speed (in the middle of the stop if the scan stops), the ones
+        # within a quarter of a scan period of the previous one are
+        # noise in the turnaround
+        T_scan = int(1. / fscan / dt) if fscan > 0 else len(az)
+        moving = np.flatnonzero(abs(v_smooth) > vlim * speed)
+        sgn = np.sign(v_smooth[moving])
+        i_flip = np.flatnonzero(sgn[1:] != sgn[:-1])
+        flips = (moving[i_flip] + moving[i_flip+1] + 1) // 2
+        keep = np.ones(len(flips), dtype=bool)
+        last = -T_scan
+        for i, f in enumerate(flips):
+            keep[i] = (f - last) > T_scan // 4
+            if keep[i]:
+                last = f
+        turnarounds = flips[keep]
+
+        # the swings are the sweeps in one direction between two
+        # consecutive turnarounds, without the turning part where the
+        # scan slows down
+        pivot = turnarounds[0] if len(turnarounds) > 0 else 0
+        fast = np.flatnonzero(abs(v_smooth) > vswing * speed)
+        first = np.searchsorted(fast, turnarounds[:-1])
+        last = np.searchsorted(fast, turnarounds[1:]) - 1
+        ok = first <= last
+        swings = np.array([fast[first[ok]], fast[last[ok]] + 1],
+                          dtype=int).T.reshape(-1, 2)
+        N_swing = len(swings)
+        T_swing = int(np.min(swings[:, 1] - swings[:, 0])) if N_swing > 0 else 0
 
         # return scan parameters
         scan = {
@@ -167,9 +174,11 @@ class AnalyzeScan(Routine):
             # "az_speed": speed,
             "scan_freq": fscan,
             # "az_cuts": c_vect,
-            # "T": T_scan,
-            # "pivot": pivot,
-            # "N": N_scan
+            "T": T_swing,
+            "pivot": pivot,
+            "N": N_swing,
+            "swings": swings,
+            "turnarounds": turnarounds
         }
         return scan
 
@@ -233,182 +242,137 @@ class AnalyzeTemperature(Routine):
         store.set(self.outputs.get('thermal'), thermal_results)
 
 
-class AnalyzeDarkLF(Routine):
+class AnalyzeLF(Routine):
     def __init__(self, **params):
+        """This routine performs the low frequency analysis of both the
+        dark and the live detectors. The dark detector data of each
+        frequency window is gathered once and used both for the dark
+        statistics and for the dark modes to deproject from the live
+        detectors.
+
+        Params:
+            dark: parameters of the dark detector analysis, same as for
+                  AnalyzeDarkLF, None to skip it
+            live: parameters of the live detector analysis, same as for
+                  AnalyzeLiveLF, None to skip it. With separateFreqs the
+                  detectors of each nom_freq are analyzed separately,
+                  bandWorkers (2) bands at a time in threads
+            reuseBuffers: keep the gathered data buffers across TODs
+
+        With ccRank > 0 in the dark or live parameters, the correlation
+        matrix cc of each window is also exported as a rank ccRank factor
+        F (ndet x nwin x ccRank, cc ~ F F^H, see rebuild_cc) in the
+        cc_dark or cc_live outputs, with the windows as index ranges of
+        the spectrum and its df
+        """
         Routine.__init__(self)
         self.inputs = params.get('inputs', None)
         self.outputs = params.get('outputs', None)
-        self._dets = params.get('dets', None)
-        self._fft_data = params.get('fft_data', None)
-        self._tod = params.get('tod', None)
-        self._output_key = params.get('output_key', None)
-        self._scan = params.get('scan', None)
-        self._freqRange = params.get('freqRange', None)
-        self._double_mode = params.get('doubleMode', False)
-        self._params = params
+        self._dark = params.get('dark', None)
+        self._live = params.get('live', None)
+        self._pool = BufferPool() if params.get('reuseBuffers', False) else None
+        self._bandPools = {}
 
     def execute(self, store):
         # retrieved relevant data from data store
         tod = store.get(self.inputs.get('tod'))
+        ndets = len(tod.info.det_uid)
+        nsamps = tod.nsamps
 
         fft_data = store.get(self.inputs.get('fft'))
         fdata = fft_data['fdata']
         df = fft_data['df']
-        
-        sel = store.get(self.inputs.get('dets'))['dark_final']
+
+        live = store.get(self.inputs.get('dets'))['live_final']
+        dark = store.get(self.inputs.get('dets'))['dark_final']
         scan_freq = store.get(self.inputs.get('scan'))['scan_freq']
 
-        # get the frequency band parameters
-        frange = self._freqRange
-        fmin = frange.get("fmin", 0.017)
-        fshift = frange.get("fshift", 0.009)
-        band = frange.get("band", 0.070)
-        Nwin = frange.get("Nwin", 1)
-
-        corr = []
-        gain = []
-        norm = []
-
-        minFreqElem = 16
-        # loop over freq windows
-        for i in range(Nwin):
-            # find upper / lower bounds' corresponding index in freq
-            # lower bound: fmin + [ fshifts ]
-            # upper bound: fmin + band  + [ fshifts ]
-            n_l = int(round((fmin + i*fshift)/df))
-            n_h = int(round((fmin + i*fshift + band)/df))
-
-            # if there are too few elements then add a few more to
-            # have exactly the minimum required
-            if (n_h - n_l) < minFreqElem:
-                n_h = n_l + minFreqElem
-
-            # perform low frequency analysis
-            r = self.lowFreqAnal(fdata, sel, [n_l, n_h], df,
-                                 tod.nsamps, scan_freq)
-
-            # append the results to the relevant lists
-            corr.append(r["corr"])
-            gain.append(np.abs(r["gain"]))
-            norm.append(r["norm"])
+        # find the windows in which dark detector data are needed: the
+        # dark analysis windows and the live windows for dark modes
+        windows = []
+        if self._dark is not None:
+            windows.extend(get_lf_windows(self._dark.get('freqRange'), df))
+        if self._live is not None and self._live.get('removeDark', False):
+            if dark is None:
+                print("ERROR: no dark selection supplied")
+                return 0
+            windows.extend(get_lf_windows(self._live.get('freqRange'), df))
+        windows = sorted(set(windows))
+
+        # gather the dark detector data once
+        fcmodes = {}
+        darkStats = []
+        if len(windows) > 0:
+            darkWins = get_lf_windows(self._dark.get('freqRange'), df) \
+                       if self._dark is not None else []
+            for iwin, dark_data in get_lf_stacks(fdata, dark, windows,
+                                                 pool=self._pool,
+                                                 name='dark_data'):
+                wins = [windows[i] for i in iwin]
+                dark_norm = np.linalg.norm(dark_data, axis=2)
+                # the dark modes are found from the data before the
+                # dark analysis modifies it
+                if self._live is not None and self._live.get('removeDark', False):
+                    fcmodes.update(zip(wins, self.getDarkModes(dark_data,
+                                                               dark_norm)))
+                if self._dark is not None:
+                    j = [k for k, w in enumerate(wins) if w in darkWins]
+                    if len(j) < len(wins):
+                        dark_data, dark_norm = dark_data[j], dark_norm[j]
+                        wins = [wins[k] for k in j]
+                    if len(wins) > 0:
+                        r = self.lowFreqAnal(dark_data, dark, wins, df, nsamps,
+                                             scan_freq, self._dark, fnorm=dark_norm)
+                        darkStats.extend(zip(wins, r["corr"], r["gain"],
+                                             r["norm"], r["ccFactor"]))
+
+        if self._dark is not None:
+            self.darkAnal(store, dark, darkStats, df)
+
+        if self._live is not None:
+            self.liveAnal(store, tod, fdata, df, live, scan_freq, fcmodes)
+
+    def darkAnal(self, store, sel, darkStats, df):
+        """Summarize the statistics of the dark detectors over the
+        frequency windows"""
+        darkStats.sort(key=lambda x: x[0])
+        corr = np.array([x[1] for x in darkStats])
+        gain = np.array([x[2] for x in darkStats])
+        norm = np.array([x[3] for x in darkStats])
+
+        # low rank factors of the correlation matrices, detectors first
+        if self._dark.get('ccRank', 0) > 0:
+            store.set(self.outputs.get('cc_dark'), {
+                'factor': np.array([x[4] for x in darkStats]).transpose(1, 0, 2),
+                'windows': np.array([x[0] for x in darkStats]),
+                'df': df,
+            })
 
         # normalize gain
         for g in gain:
             g /= np.mean(g[sel])
-            
-        gain = np.array(gain)
-        
+
         # give a default gain of 0 for invalid data
         gain[np.isnan(gain)] = 0.
 
-        # use mean as representative values for gain
-        mgain = ma.MaskedArray(gain, ~np.array(sel))
-        mgain_mean = mgain.mean(axis=0)
-
-        # use max as representative values for corr
-        mcorr = ma.MaskedArray(corr, ~np.array(sel))
-        mcorr_max = mcorr.max(axis=0)
-
-        # use mean as representative values for norm
-        mnorm = ma.MaskedArray(norm, ~np.array(sel))
-        mnorm_mean = mnorm.mean(axis=0)
-        
-        # export the values
+        # export the values: max as representative values for corr and
+        # mean for gain and norm
         results = {}
-        
-        results["corrDark"] = mcorr_max.data,
-        results["gainDark"] = mgain_mean.data
-        results["normDark"] = mnorm_mean.data
+
+        results["corrDark"] = sel_max(corr, sel),
+        results["gainDark"] = sel_mean(gain, sel)
+        results["normDark"] = sel_mean(norm, sel)
 
         # save to the data store
         store.set(self.outputs.get('lf_dark'), results)
-        
-    def lowFreqAnal(self, fdata, sel, frange, df, nsamps, scan_freq):
-        """Find correlations and gains to the main common mode over a
-        frequency range
-        """
-        self.logger.info("Analyzing freqs %s" % frange)
-        # get relevant low freq data in the detectors selected
-        lf_data = fdata[sel, frange[0]:frange[1]]
-        ndet = len(sel)
-        res = {}
-
-        # Scan frequency rejection
-        if self._params.get("cancelSync", False) and (scan_freq/df > 7):
-            i_harm = get_iharm(frange, df, scan_freq,
-                               wide=self._params.get("wide",True))
-            lf_data[:, i_harm] = 0.0
-
-        # Get correlation matrix
-        c = np.dot(lf_data, lf_data.T.conjugate())
-        a = np.linalg.norm(lf_data, axis=1)
-        aa = np.outer(a,a)
-        aa[aa==0.] = 1.
-        cc = c/aa
-
-        # Get Norm
-        norm = np.zeros(ndet,dtype=float)
-        fnorm = np.sqrt(np.abs(np.diag(c)))
-        norm[sel] = fnorm*np.sqrt(2./nsamps)
-        nnorm = norm/np.sqrt(nsamps)
-
-        # Get Correlations
-        u, s, v = np.linalg.svd(lf_data, full_matrices=False)
-        corr = np.zeros(ndet)
-        if self._double_mode:
-            corr[sel] = np.sqrt(abs(u[:,0]*s[0])**2+abs(u[:,1]*s[1])**2)/fnorm
-        else:
-            corr[sel] = np.abs(u[:,0])*s[0]/fnorm
 
-        # Get Gains
-        # data = CM * gain
-        gain = np.zeros(ndet, dtype=complex)
-        gain[sel] = np.abs(u[:, 0])
-        res.update({
-            "corr": corr,
-            "gain": gain,
-            "norm": norm,
-            "cc": cc
-        })
-        return res
-
-
-class AnalyzeLiveLF(Routine):
-    def __init__(self, **params):
-        Routine.__init__(self)
-        self.inputs = params.get('inputs', None)
-        self.outputs = params.get('outputs', None)
-        self._freqRange = params.get('freqRange', None)
-        self._separateFreqs = params.get('separateFreqs', False)
-        self._full = params.get('fullReport', False)
-        self._removeDark = params.get('removeDark', False)
-        self._darkModesParams = params.get('darkModesParams', {})
-        self._forceResp = params.get("forceResp", True)
-        self._params = params
-
-    def execute(self, store):
-        # similar to the dark analysis, for more comments please refer to
-        # the AnalyzeDarkLF
-        
-        # retrieve relevant data from store
-        # tod, number of detectors and number of samples
-        tod = store.get(self.inputs.get('tod'))
+    def liveAnal(self, store, tod, fdata, df, live, scan_freq, fcmodes):
+        """Find the statistics of the live detectors over the frequency
+        windows, after deprojecting the dark modes if requested"""
+        params = self._live
         ndets = len(tod.info.det_uid)
         nsamps = tod.nsamps
 
-        # retrieve detector lists
-        live = store.get(self.inputs.get('dets'))['live_final']
-        dark = store.get(self.inputs.get('dets'))['dark_final']
-
-        # retrieve fft related data
-        fft_data = store.get(self.inputs.get('fft'))
-        fdata = fft_data['fdata']
-        df = fft_data['df']
-        nf = fft_data['nf']
-
-        # retrieve scan frequency
-        scan_freq = store.get(self.inputs.get('scan'))['scan_freq']
-
         # retrieve calibration data
         calData = store.get(self.inputs.get('cal'))
         respSel = calData['respSel']
@@ -420,113 +384,55 @@ class AnalyzeLiveLF(Routine):
         fbandSel = []
         fbands = []
         # if we want to treat different frequencies separately
-        if self._separateFreqs:
+        if params.get('separateFreqs', False):
             # gather the different frequency bands
             # i.e. 90GHz, 150GHz, etc
-            fbs = np.array(list(set(tod.info.array_data["nom_freq"])))
+            nom_freq = np.asarray(tod.info.array_data["nom_freq"])
+            fbs = np.array(sorted(set(nom_freq)))
             fbs = fbs[fbs != 0]
             for fb in fbs:
                 # store the live detectors of each frequencies into the respective list
-                self.fbandSel.append((tod.info.array_data["nom_freq"] == fb)*live)
-                self.fbands.append(str(int(fb)))
+                fbandSel.append((nom_freq == fb)*live)
+                fbands.append(str(int(fb)))
         else:
             fbandSel.append(live)
             fbands.append("all")
 
-        # initialize the preselection for live detectors
-        preLiveSel = np.zeros(ndets, dtype=bool)
-        liveSel = np.zeros(ndets, dtype=bool)
-
         # initialize vectors to store the statistics for live data
         crit = {}
         crit["darkRatioLive"] = np.zeros(ndets, dtype=float)
         crit["corrLive"] = np.zeros(ndets, dtype=float)
         crit["gainLive"] = np.zeros(ndets, dtype=float)
         crit["normLive"] = np.zeros(ndets, dtype=float)
+        rank = params.get('ccRank', 0)
+        windows = get_lf_windows(params.get('freqRange'), df)
+        if rank > 0:
+            ccFactor = np.zeros((ndets, len(windows), rank), dtype=fdata.dtype)
 
         # if resp will be used
-        if not self._forceResp:
+        if not params.get("forceResp", True):
             respSel = None
 
-        # get the frequency band parameters
-        frange = self._freqRange
-        fmin = frange.get("fmin", 0.017)
-        fshift = frange.get("fshift", 0.009)
-        band = frange.get("band", 0.070)
-        Nwin = frange.get("Nwin", 1)
-
-        # loop over frequency band
-        for fbSel,fbn in zip(fbandSel, fbands):
-            all_data = []
-
-            sel = []            
-            corr = []
-            gain = []
-            norm = []
-            darkRatio = []
-
-            fcm = []
-            cm = []
-            cmdt = []
-            
-            minFreqElem = 16
-            for i in range(Nwin):
-                n_l = int(round((fmin + i*fshift)/df))
-                n_h = int(round((fmin + i*fshift + band)/df))
-                                
-                if (n_h - n_l) < minFreqElem:
-                    n_h = n_l + minFreqElem
-
-                if self._removeDark:
-                    if dark is None:
-                        print("ERROR: no dark selection supplied")
-                        return 0
-
-                    fcmi, cmi, cmdti = self.getDarkModes(fdata, dark, [n_l,n_h],
-                                                         df, nf, nsamps)
-                    fcm.append(fcmi)
-                    cm.append(cmi)
-                    cmdt.append(cmdti)
-
-                r = self.lowFreqAnal(fdata, live, [n_l,n_h], df, nsamps, scan_freq,
-                                     fcmodes=fcmi, respSel=respSel, flatfield=flatfield)
-
-                sel.append(live)                
-                corr.append(r["corr"])
-                gain.append(np.abs(r["gain"]))
-                norm.append(r["norm"])
-                darkRatio.append(r["ratio"])
-
-                if self._full:
-                    all_data.append(r)
-                    
-            for g in gain:
-                g /= np.mean(g[live])
-                
-            gain = np.array(gain)
-            gain[np.isnan(gain)] = 0.
-
-
-            mgain = ma.MaskedArray(gain,~np.array(sel))
-            mgain_mean = mgain.mean(axis=0)
-            mcorr = ma.MaskedArray(corr,~np.array(sel))
-
-            mcorr_max = mcorr.max(axis=0)
-            mnorm = ma.MaskedArray(norm,~np.array(sel))
-            mnorm_mean = mnorm.mean(axis=0)
-
-            # summarize the results so far
-            results = {
-                "corr": mcorr_max.data,
-                "gain": mgain_mean.data,
-                "norm": mnorm_mean.data,
-            }
-
-            if self._removeDark:
-                mdarkRatio = ma.MaskedArray(darkRatio,~np.array(sel))
-                mdarkRatio_mean = mdarkRatio.mean(axis=0)
-                results['darkRatio'] = mdarkRatio_mean.data
+        # analyze the frequency bands concurrently, each band gathers
+        # only its own detectors in its own buffers so the memory used
+        # is bounded by the number of workers
+        def analyze(fb):
+            fbSel, fbn = fb
+            pool = None
+            if self._pool is not None:
+                pool = self._bandPools.setdefault(fbn, BufferPool())
+            self.logger.info("Analyzing frequency band %s" % fbn)
+            return self.bandAnal(fdata, fbSel, df, nsamps, scan_freq, fcmodes,
+                                 respSel, flatfield, pool)
+
+        nworkers = min(params.get('bandWorkers', 2), len(fbands))
+        if nworkers > 1:
+            with ThreadPoolExecutor(max_workers=nworkers) as executor:
+                band_results = list(executor.map(analyze, zip(fbandSel, fbands)))
+        else:
+            band_results = [analyze(fb) for fb in zip(fbandSel, fbands)]
 
+        for fbSel, results in zip(fbandSel, band_results):
             # update the crit dictionary to output
             crit['corrLive'][fbSel] = results["corr"][fbSel]
             crit['gainLive'][fbSel] = results["gain"][fbSel]
@@ -535,131 +441,263 @@ class AnalyzeLiveLF(Routine):
             if 'darkRatio' in results:
                 crit["darkRatioLive"][fbSel] = results["darkRatio"][fbSel]
 
+            if rank > 0:
+                ccFactor[fbSel] = results["ccFactor"].transpose(1, 0, 2)[fbSel]
+
         # Undo flatfield correction
         crit["gainLive"] /= np.abs(ff)
 
         store.set(self.outputs.get('lf_live'), crit)
 
+        # low rank factors of the correlation matrices, detectors first
+        if rank > 0:
+            store.set(self.outputs.get('cc_live'), {
+                'factor': ccFactor,
+                'windows': np.array(windows),
+                'df': df,
+            })
+
+    def bandAnal(self, fdata, sel, df, nsamps, scan_freq, fcmodes,
+                 respSel, flatfield, pool):
+        """Find the statistics of the detectors sel (the live detectors
+        of a frequency band) over the frequency windows"""
+        params = self._live
+        removeDark = params.get('removeDark', False)
+        ndets = len(sel)
+        all_data = []
+
+        windows = get_lf_windows(params.get('freqRange'), df)
+        corr = np.zeros((len(windows), ndets))
+        gain = np.zeros((len(windows), ndets))
+        norm = np.zeros((len(windows), ndets))
+        darkRatio = np.zeros((len(windows), ndets))
+        ccFactor = np.zeros((len(windows), ndets, params.get('ccRank', 0)),
+                            dtype=fdata.dtype)
+
+        # gather the data once and analyze the windows of equal width
+        # together
+        for iwin, lf_data in get_lf_stacks(fdata, sel, windows, pool=pool):
+            wins = [windows[i] for i in iwin]
+            fcm = [fcmodes[w] for w in wins] if removeDark else None
+            r = self.lowFreqAnal(lf_data, sel, wins, df, nsamps, scan_freq,
+                                 params, fcmodes=fcm, respSel=respSel,
+                                 flatfield=flatfield)
+
+            corr[iwin] = r["corr"]
+            gain[iwin] = r["gain"]
+            norm[iwin] = r["norm"]
+            ccFactor[iwin] = r["ccFactor"]
+            if removeDark:
+                darkRatio[iwin] = r["ratio"]
+
+            if params.get('fullReport', False):
+                all_data.append(r)
+
+        for g in gain:
+            g /= np.mean(g[sel])
+        gain[np.isnan(gain)] = 0.
+
+        # summarize the results so far
+        results = {
+            "corr": sel_max(corr, sel),
+            "gain": sel_mean(gain, sel),
+            "norm": sel_mean(norm, sel),
+            "ccFactor": ccFactor,
+        }
 
-    def lowFreqAnal(self, fdata, sel, frange, df, nsamps, scan_freq,
-                    fcmodes=None, respSel=None, flatfield=None):
-        """Find correlations and gains to the main common mode over a
-        frequency range
+        if removeDark:
+            results['darkRatio'] = sel_mean(darkRatio, sel)
+
+        return results
+
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        bins = []
+        for params in [self._dark, self._live]:
+            if params is not None:
+                windows = get_lf_windows(params.get('freqRange'), df)
+                bins.append((min([n_l for n_l, n_h in windows]),
+                             max([n_h for n_l, n_h in windows])))
+        return bins
+
+    def lowFreqAnal(self, lf_data, sel, windows, df, nsamps, scan_freq,
+                    params, fcmodes=None, respSel=None, flatfield=None,
+                    fnorm=None):
+        """Find correlations and gains to the main common mode over
+        frequency windows of equal width, given the stacked data of the
+        selected detectors lf_data (nwin x nsel x nfreq) and optionally
+        the modes to deproject in each window. fnorm is the norm of
+        lf_data if already known.
         """
-        self.logger.info("Analyzing freqs %s" % frange)
-        # get relevant low freq data in the detectors selected
-        lf_data = fdata[sel, frange[0]:frange[1]]
+        self.logger.info("Analyzing freqs %s" % windows)
+        nwin = len(windows)
         ndet = len(sel)
         res = {}
 
         # Deproject correlated modes
         if fcmodes is not None:
-            data_norm = np.linalg.norm(lf_data,axis=1)
-            dark_coeff = []
+            data_norm = np.linalg.norm(lf_data, axis=2)
+            dcoeff = []
+
+            for d, modes in zip(lf_data, fcmodes):
+                dark_coeff = []
 
-            # actually do the deprojection here
-            for m in fcmodes:
-                coeff = np.dot(lf_data.conj(),m)
-                lf_data -= np.outer(coeff.conj(),m)
-                dark_coeff.append(coeff)
+                # actually do the deprojection here
+                for m in modes:
+                    coeff = np.dot(d.conj(),m)
+                    d -= np.outer(coeff.conj(),m)
+                    dark_coeff.append(coeff)
 
-            # Reformat dark coefficients
-            if len(dark_coeff) > 0:
-                dcoeff = np.zeros([len(dark_coeff),ndet],dtype=complex)
-                dcoeff[:,sel] = np.array(dark_coeff)
+                # Reformat dark coefficients
+                dc = np.zeros([len(dark_coeff),ndet],dtype=complex)
+                if len(dark_coeff) > 0:
+                    dc[:,sel] = np.array(dark_coeff)
+                dcoeff.append(dc)
 
             # Get Ratio
-            ratio = np.zeros(ndet,dtype=float)
+            ratio = np.zeros((nwin, ndet), dtype=float)
             data_norm[data_norm==0.] = 1.
             # after deprojection versus before deprojection
             # this should really be called live ratio than dark ratio
-            ratio[sel] = np.linalg.norm(lf_data,axis=1)/data_norm
+            ratio[:, sel] = np.linalg.norm(lf_data, axis=2)/data_norm
+            res.update({"dcoeff": dcoeff, "ratio": ratio})
+            fnorm = None
 
         # Scan frequency rejection
-        if self._params.get("cancelSync",False) and (scan_freq/df > 7):
-            i_harm = get_iharm(frange, df, scan_freq,
-                               wide=self._params.get("wide",True))
-            lf_data[:, i_harm] = 0.0
-
-        # Get correlation matrix
-        c = np.dot(lf_data, lf_data.T.conjugate())
-        a = np.linalg.norm(lf_data, axis=1)
-        aa = np.outer(a,a)
-        aa[aa==0.] = 1.
-        cc = c/aa
+        if params.get("cancelSync",False) and (scan_freq/df > 7):
+            for d, frange in zip(lf_data, windows):
+                i_harm = get_iharm(frange, df, scan_freq,
+                                   wide=params.get("wide",True))
+                d[:, i_harm] = 0.0
+            fnorm = None
 
         # Get Norm
-        norm = np.zeros(ndet,dtype=float)
-        fnorm = np.sqrt(np.abs(np.diag(c)))
-        norm[sel] = fnorm*np.sqrt(2./nsamps)
-        nnorm = norm/np.sqrt(nsamps)
+        norm = np.zeros((nwin, ndet), dtype=float)
+        if fnorm is None:
+            fnorm = np.linalg.norm(lf_data, axis=2)
+        norm[:, sel] = fnorm*np.sqrt(2./nsamps)
+
+        # Get correlation matrix, only needed for diagnostics
+        if params.get('diagnostics', False):
+            c = np.matmul(lf_data, lf_data.conjugate().transpose(0, 2, 1))
+            aa = fnorm[:, :, np.newaxis] * fnorm[:, np.newaxis, :]
+            aa[aa==0.] = 1.
+            res["cc"] = c/aa
 
         # Apply gain ratio in case of multichroic
+        scl = 1.
         if (flatfield is not None) and ("scale" in flatfield.fields):
-            scl = flatfield.get_property("scale", det_uid=np.where(sel)[0],
-                                         default = 1.)
-            lf_data *= np.repeat([scl],lf_data.shape[1],axis=0).T
+            scl = np.asarray(flatfield.get_property("scale", det_uid=np.where(sel)[0],
+                                                    default = 1.))
+            lf_data *= scl[np.newaxis, :, np.newaxis]
 
         # Get Correlations
-        u, s, v = np.linalg.svd(lf_data, full_matrices=False )
+        u, s, v = np.linalg.svd(lf_data, full_matrices=False)
 
-        corr = np.zeros(ndet)
-        if self._params.get("doubleMode", False):
-            corr[sel] = np.sqrt(abs(u[:,0]*s[0])**2+abs(u[:,1]*s[1])**2)/fnorm
+        corr = np.zeros((nwin, ndet))
+        if params.get("doubleMode", False):
+            corr[:, sel] = np.sqrt(abs(u[:,:,0]*s[:,0,np.newaxis])**2 +
+                                   abs(u[:,:,1]*s[:,1,np.newaxis])**2)/fnorm
         else:
-            corr[sel] = np.abs(u[:,0])*s[0]/fnorm
+            corr[:, sel] = np.abs(u[:,:,0])*s[:,0,np.newaxis]/fnorm
 
         # Get Gains
         # data = CM * gain
-        gain = np.zeros(ndet, dtype=complex)
-        gain[sel] = np.abs(u[:, 0])
-        
-        res.update({"corr": corr, "gain": gain, "norm": norm, "dcoeff": dcoeff,
-                    "ratio": ratio, "cc": cc})
-        
+        gain = np.zeros((nwin, ndet))
+        gain[:, sel] = np.abs(u[:,:,0])
+
+        # Low rank factor F of the correlation matrix, cc ~ F F^H, from
+        # the main singular vectors (without the gain ratio)
+        rank = params.get('ccRank', 0)
+        factor = np.zeros((nwin, ndet, rank), dtype=u.dtype)
+        if rank > 0:
+            k = min(rank, s.shape[1])
+            wnorm = fnorm * scl
+            wnorm[wnorm == 0.] = 1.
+            f = np.zeros((nwin, u.shape[1], rank), dtype=u.dtype)
+            f[:, :, :k] = u[:, :, :k] * s[:, np.newaxis, :k] / wnorm[:, :, np.newaxis]
+            factor[:, sel] = f
+
+        res.update({"corr": corr, "gain": gain, "norm": norm,
+                    "ccFactor": factor})
+
         return res
 
-    def getDarkModes(self, fdata, darkSel, frange, df, nf, nsamps):
+    def getDarkModes(self, dark_data, dark_norm):
         """
-        @brief Get dark or thermal modes from dark detectors and thermometer
-               data.
-        @return correlated modes in frequency and time domain, plus thermometer
-                info.
+        @brief Get the dark modes to deproject from the live detectors in
+               each window, from the stacked dark detector data
+               (nwin x ndark x nfreq) and its norm
+        @return list of the correlated modes in frequency of each window
         """
-        self.logger.info("Finding dark modes in freqs %s" % frange)        
-        n_l, n_h=frange
-        fc_inputs = []
+        darkModesParams = self._live.get('darkModesParams', {})
+        self.logger.info("Finding dark modes")
 
         # Dark detector drift
-        if self._darkModesParams.get("useDarks", False):
-            dark_signal = fdata[darkSel,n_l:n_h].copy()
-            fc_inputs.extend(list(dark_signal))
-
-        fc_inputs = np.array(fc_inputs)
+        if not darkModesParams.get("useDarks", False):
+            raise ValueError("Dark modes require useDarks")
 
         # Normalize modes
-        fc_inputs /= np.linalg.norm(fc_inputs, axis=1)[:, np.newaxis]
+        fc_inputs = dark_data / dark_norm[:, :, np.newaxis]
 
         # Obtain main svd modes to deproject from data
-        if self._darkModesParams.get("useSVD", False):
-            Nmodes = self._darkModesParams.get("Nmodes", None)
-            u, s, v = np.linalg.svd( fc_inputs, full_matrices=False )
+        if darkModesParams.get("useSVD", False):
+            Nmodes = darkModesParams.get("Nmodes", None)
+            u, s, v = np.linalg.svd(fc_inputs, full_matrices=False)
             if Nmodes is None:
                 # drop the bottom 10%
-                fcmodes = v[s > s.max()/10]
+                return [vi[si > si.max()/10] for si, vi in zip(s, v)]
             else:
-                fcmodes = v[:Nmodes]
+                return list(v[:, :Nmodes])
         else:
-            fcmodes = fc_inputs
+            return list(fc_inputs)
 
-        # Get modes in time domain
-        cmodes, cmodes_dt = get_time_domain_modes(
-            fcmodes, n_l, nsamps, df)
-        cmodes /= np.linalg.norm(cmodes, axis=1)[:, np.newaxis]
-        return fcmodes, cmodes, cmodes_dt
-        
 
-class GetDriftErrors(Routine):
+class AnalyzeDarkLF(AnalyzeLF):
+    def __init__(self, **params):
+        """This routine performs the low frequency analysis of the dark
+        detectors only, see AnalyzeLF"""
+        AnalyzeLF.__init__(self, inputs=params.get('inputs', None),
+                           outputs=params.get('outputs', None), dark=params,
+                           reuseBuffers=params.get('reuseBuffers', False))
+
+
+class AnalyzeLiveLF(AnalyzeLF):
+    def __init__(self, **params):
+        """This routine performs the low frequency analysis of the live
+        detectors only, see AnalyzeLF"""
+        AnalyzeLF.__init__(self, inputs=params.get('inputs', None),
+                           outputs=params.get('outputs', None), live=params,
+                           reuseBuffers=params.get('reuseBuffers', False))
+
+
+class CommonModeDeprojection(object):
+    """Common mode deprojection of the routines that analyze a band of
+    the spectrum after removing its main common modes (GetDriftErrors,
+    AnalyzeLiveMF and AnalyzeHF)"""
+    def init_deprojection(self, params):
+        """Read the deprojection parameters: deprojMethod (see
+        get_common_modes), deprojDtype and subspaceParams (passed to
+        CommonModeSolver)"""
+        self._deprojMethod = params.get('deprojMethod', 'eigh')
+        self._deprojDtype = params.get('deprojDtype', 'complex128')
+        self._solver = CommonModeSolver(**params.get('subspaceParams', {}))
+
+    def deproject(self, data, nmodes, sel, array, band):
+        """Remove the nmodes main common modes from data, the band of the
+        detectors sel, in place (see deproject_modes). The subspace
+        iteration is seeded per array and band"""
+        key = None if array is None else (array, band)
+        deproject_modes(data, nmodes, method=self._deprojMethod,
+                        dtype=self._deprojDtype, solver=self._solver,
+                        sel=sel, key=key)
+        if self._deprojMethod == 'subspace':
+            self.logger.info("Subspace iteration: %(niter)d iterations, "
+                             "angle %(angle).1e, seeded %(seeded)s, "
+                             "fallback %(fallback)s" % self._solver.info)
+
+
+class GetDriftErrors(CommonModeDeprojection, Routine):
     def __init__(self, **params):
         """This routine obtains the pickle parameter DELive by performing
         a high frequency analysis on the slow modes"""
@@ -668,6 +706,8 @@ class GetDriftErrors(Routine):
         self.outputs = params.get('outputs', None)
         self._driftFilter = params.get('driftFilter', None)
         self._nmodes = params.get('nmodes', 1)
+        self.init_deprojection(params)
+        self._pool = BufferPool() if params.get('reuseBuffers', False) else None
 
     def execute(self, store):
         tod = store.get(self.inputs.get('tod'))
@@ -683,25 +723,19 @@ class GetDriftErrors(Routine):
         nmodes = self._nmodes
 
         # find the range of frequencies of interests
-        n_l = 1
-        n_h = nextregular(int(round(self._driftFilter/df))) + 1
+        [(n_l, n_h)] = self.freq_bins(df)
 
         # get drift errors
         ndets = len(live)
-        hf_data = fdata[live, n_l:n_h]
+        hf_data = get_band_data(fdata, live, n_l, n_h, pool=self._pool,
+                                name='hf_data')
 
         # remove first [nmodes] common modes
         if nmodes > 0:
-            # find the correlation between different detectors
-            c = np.dot(hf_data, hf_data.T.conjugate())
-
             # find the first few common modes in the detectors and
             # deproject them
-            u, w, v = np.linalg.svd(c, full_matrices = 0)
-            kernel = v[:nmodes]/np.repeat([np.sqrt(w[:nmodes])],len(c),axis=0).T
-            modes = np.dot(kernel, hf_data)
-            coeff = np.dot(modes, hf_data.T.conj())
-            hf_data -= np.dot(coeff.T.conj(), modes)
+            self.deproject(hf_data, nmodes, live, getattr(tod.info, 'array', None),
+                           'drift')
 
         # compute the rms for the detectors
         rms = np.zeros(ndets)
@@ -713,8 +747,14 @@ class GetDriftErrors(Routine):
 
         store.set(self.outputs.get('drift'), results)
 
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        n_l = 1
+        n_h = nextregular(int(round(self._driftFilter/df))) + 1
+        return [(n_l, n_h)]
+
 
-class AnalyzeLiveMF(Routine):
+class AnalyzeLiveMF(CommonModeDeprojection, Routine):
     def __init__(self, **params):
         """This routine looks at the mid-frequency and perform a 
         high-freq like analysis to get the pickle parameter MFE"""
@@ -723,6 +763,8 @@ class AnalyzeLiveMF(Routine):
         self.outputs = params.get('outputs', None)
         self._midFreqFilter = params.get("midFreqFilter", None)
         self._nmodes = params.get("nmodes", 1)
+        self.init_deprojection(params)
+        self._pool = BufferPool() if params.get('reuseBuffers', False) else None
 
     def execute(self, store):
         tod = store.get(self.inputs.get('tod'))
@@ -738,26 +780,20 @@ class AnalyzeLiveMF(Routine):
         nmodes = self._nmodes
 
         # get the frequency range to work on
-        n_l = int(self._midFreqFilter[0]/df)
-        n_h = int(self._midFreqFilter[1]/df)
+        [(n_l, n_h)] = self.freq_bins(df)
 
         # get drift errors
         ndets = len(live)
-        hf_data = fdata[live, n_l:n_h]
+        hf_data = get_band_data(fdata, live, n_l, n_h, pool=self._pool,
+                                name='hf_data')
         
         # remove first [nmodes] common modes
         if nmodes > 0:
             self.logger.info("Deprojecting %d modes" % nmodes)
-            # find the correlation between different detectors
-            c = np.dot(hf_data, hf_data.T.conjugate())
-
             # find the first few common modes in the detectors and
             # deproject them
-            u, w, v = np.linalg.svd(c, full_matrices = 0)
-            kernel = v[:nmodes]/np.repeat([np.sqrt(w[:nmodes])],len(c),axis=0).T
-            modes = np.dot(kernel, hf_data)
-            coeff = np.dot(modes, hf_data.T.conj())
-            hf_data -= np.dot(coeff.T.conj(), modes)
+            self.deproject(hf_data, nmodes, live, getattr(tod.info, 'array', None),
+                           'mf')
 
         # compute the rms for the detectors
         rms = np.zeros(ndets)
@@ -769,8 +805,14 @@ class AnalyzeLiveMF(Routine):
 
         store.set(self.outputs.get('mf_live'), results)
 
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        n_l = int(self._midFreqFilter[0]/df)
+        n_h = int(self._midFreqFilter[1]/df)
+        return [(n_l, n_h)]
+
 
-class AnalyzeHF(Routine):
+class AnalyzeHF(CommonModeDeprojection, Routine):
     def __init__(self, **params):
         """This routine analyzes both live and dark detectors in
         the high frequency band"""
@@ -782,6 +824,9 @@ class AnalyzeHF(Routine):
         self._nmodes_live = params.get('nLiveModes', 1)
         self._nmodes_dark = params.get('nDarkModes', 1)
         self._highOrder = params.get('highOrder', False)
+        self.init_deprojection(params)
+        self._blockSize = params.get('blockSize', 64)
+        self._pool = BufferPool() if params.get('reuseBuffers', False) else None
         self._params = params
 
     def execute(self, store):
@@ -796,17 +841,15 @@ class AnalyzeHF(Routine):
         fft_data = store.get(self.inputs.get('fft'))
         fdata = fft_data['fdata']
         df = fft_data['df']
+        nf = fft_data['nf']
 
         scan = store.get(self.inputs.get('scan'))
+        array = getattr(tod.info, 'array', None)
         nmodes_live = self._nmodes_live
         nmodes_dark = self._nmodes_dark
 
         # get the range of frequencies to work with
-        n_l = int(round(self._highFreqFilter[0]/df))
-        n_h = int(round(self._highFreqFilter[1]/df))
-
-        # make sure that n_h is a number that's optimized in fft
-        n_h = nextregular(n_h-n_l) + n_l
+        [(n_l, n_h)] = self.freq_bins(df)
 
         # empty dictionary to store the results
         results = {}
@@ -818,15 +861,19 @@ class AnalyzeHF(Routine):
             self.logger.info("Performing non-partial analysis")
             rms, skewt, kurtt = self.highFreqAnal(fdata, live, [n_l,n_h], nsamps,
                                                   highOrder=self._highOrder,
-                                                  nmodes=nmodes_live)
+                                                  nmodes=nmodes_live, array=array,
+                                                  band='hf_live')
         else:
             self.logger.info("Performing partial analysis")
             rms, skewt, kurtt, prms, pskewt, pkurtt = self.highFreqAnal(fdata, live, 
                                                                         [n_l,n_h],
                                                                         nsamps,
+                                                                        nf=nf,
                                                                         nmodes=nmodes_live,
                                                                         highOrder=self._highOrder,
-                                                                        scanParams=scan)
+                                                                        scanParams=scan,
+                                                                        array=array,
+                                                                        band='hf_live')
 
             # store the statistics for partial
             results["partialRMSLive"] = np.zeros([ndets, scan["N"]])
@@ -855,35 +902,40 @@ class AnalyzeHF(Routine):
         # analyze the dark detectors for the same frequency range
         self.logger.info("Analyzing dark detectors")
         rms = self.highFreqAnal(fdata, dark, [n_l,n_h], nsamps, nmodes=nmodes_dark, 
-                                highOrder=False)
+                                highOrder=False, array=array, band='hf_dark')
 
         results["rmsDark"] = rms
 
         store.set(self.outputs.get('hf'), results)
 
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        n_l = int(round(self._highFreqFilter[0]/df))
+        n_h = int(round(self._highFreqFilter[1]/df))
+
+        # make sure that n_h is a number that's optimized in fft
+        n_h = nextregular(n_h-n_l) + n_l
+        return [(n_l, n_h)]
+
     def highFreqAnal(self, fdata, sel, frange, nsamps, nmodes=0, highOrder=False,
-                     scanParams=None):
+                     scanParams=None, array=None, band='hf', nf=None):
         """
-        @brief Find noise RMS, skewness and kurtosis over a frequency band
+        @brief Find noise RMS, skewness and kurtosis over a frequency band,
+               the subspace iteration is seeded per array and band. nf
+               (the fft length) is needed with scanParams
         """
         self.logger.info("Analyzing freqs %s" % frange)
         ndet = len(sel)
 
         # get the high frequency fourior modes
-        hf_data = fdata[sel, frange[0]:frange[1]]
+        hf_data = get_band_data(fdata, sel, frange[0], frange[1],
+                                pool=self._pool, name='hf_data')
 
         if nmodes > 0:
             self.logger.info("Deprojecting %d modes" % nmodes)
-            # find the correlation between different detectors
-            c = np.dot(hf_data,hf_data.T.conjugate())
-
             # find the first few common modes in the detectors and
             # deproject them
-            u, w, v = np.linalg.svd(c, full_matrices = 0)
-            kernel = v[:nmodes]/np.repeat([np.sqrt(w[:nmodes])],len(c),axis=0).T
-            modes = np.dot(kernel,hf_data)
-            coeff = np.dot(modes,hf_data.T.conj())
-            hf_data -= np.dot(coeff.T.conj(),modes)
+            self.deproject(hf_data, nmodes, sel, array, band)
 
         # compute the rms for the detectors
         rms = np.zeros(ndet)
@@ -892,28 +944,118 @@ class AnalyzeHF(Routine):
         # if we are interested in high order effects, skew and kurtosis will
         # be calculated here
         if highOrder:
-            hfd, _ = get_time_domain_modes(hf_data, 1, nsamps)
-            skewt = stat.skewtest(hfd,axis=1)
-            kurtt = stat.kurtosistest(hfd,axis=1)
+            nbins = hf_data.shape[1]
+            segments = None
+            if scanParams is not None:
+                # i see this as calculating the statistics for each
+                # swing (no turning part) so the statistics is not
+                # affected by the scan, over the same number of samples
+                # from the start of each swing
+                swings = np.asarray(scanParams["swings"]).reshape(-1, 2)
+                # the 2*nbins samples of the signal span the nf samples
+                # of the zero-padded tod
+                f = 2.*nbins/nf
+                starts = np.ceil(swings[:, 0]*f).astype(int)
+                ends = np.floor(swings[:, 1]*f).astype(int)
+                length = int(np.min(ends - starts)) if len(starts) > 0 else 0
+                segments = (starts, max(length, 0))
+            st = get_hf_stats(hf_data, nsamps, segments=segments,
+                              block_size=self._blockSize, pool=self._pool)
+            skewt = np.array([st['skew'], st['skewp']])
+            kurtt = np.array([st['kurt'], st['kurtp']])
             if scanParams is not None:
-                T = scanParams["T"]
-                pivot = scanParams["pivot"]
-                N = scanParams["N"]
-                f = float(hfd.shape[1])/nsamps
-                t = int(T*f); p = int(pivot*f)
-                prms = []; pskewt = []; pkurtt = []
-                for c in range(N):
-                    # i see this as calculating the statistics for each
-                    # swing (no turning part) so the statistics is not
-                    # affected by the scan
-                    prms.append(hfd[:,c*t+p:(c+1)*t+p].std(axis=1))
-                    pskewt.append(stat.skewtest(hfd[:,c*t+p:(c+1)*t+p],axis=1)) 
-                    pkurtt.append(stat.kurtosistest(hfd[:,c*t+p:(c+1)*t+p],axis=1)) 
-                prms = np.array(prms).T
-                pskewt = np.array(pskewt)
-                pkurtt = np.array(pkurtt)
+                prms = st['prms']
+                pskewt = np.array([st['pskew'].T, st['pskewp'].T]).transpose(1, 0, 2)
+                pkurtt = np.array([st['pkurt'].T, st['pkurtp'].T]).transpose(1, 0, 2)
                 return (rms, skewt, kurtt, prms, pskewt, pkurtt)
             else:
                 return (rms, skewt, kurtt)
         else:
-            return rms        
+            return rms
+
+
+class CheckPrecision(Routine):
+    def __init__(self, **params):
+        """This routine checks the accuracy of a single precision
+        (complex64) pipeline. It reruns a list of analysis routines on a
+        random subset of the detectors, once with the fft data of the
+        pipeline and once with a double precision fft of the same tod
+        data, and reports the largest relative deviation of each feature
+
+        Params:
+            routines: the analysis routines to check, they must have run
+                      already on the tod
+            nLive: number of live detectors sampled (32 by default)
+            nDark: number of dark detectors sampled (all by default)
+            seed: seed of the random sampling
+            tolerance: a warning is logged for the features that deviate
+                       more than this
+        """
+        Routine.__init__(self)
+        self.inputs = params.get('inputs', None)
+        self.outputs = params.get('outputs', None)
+        self._routines = params.get('routines', [])
+        self._nLive = params.get('nLive', 32)
+        self._nDark = params.get('nDark', None)
+        self._seed = params.get('seed', 0)
+        self._tolerance = params.get('tolerance', 1e-3)
+
+    def execute(self, store):
+        tod = store.get(self.inputs.get('tod'))
+        ndets = len(tod.info.det_uid)
+        dets = store.get(self.inputs.get('dets'))
+        fft_data = store.get(self.inputs.get('fft'))
+        fdata = fft_data['fdata']
+        nf = fft_data['nf']
+
+        # sample the detectors to check
+        rng = np.random.RandomState(self._seed)
+        idx = []
+        for key, n in [('live_final', self._nLive), ('dark_final', self._nDark)]:
+            d = np.flatnonzero(dets[key])
+            if n is not None and n < len(d):
+                d = rng.choice(d, n, replace=False)
+            idx.extend(d)
+        idx = np.sort(idx)
+        self.logger.info("Checking precision on %d detectors" % len(idx))
+
+        # fft data of the pipeline and in double precision
+        sub = subset_tod(tod, idx)
+        if isinstance(fdata, BandedSpectrum):
+            test = BandedSpectrum(fdata.bands, [d[idx] for d in fdata.data],
+                                  fdata.shape[1])
+            ref = BandedSpectrum.from_tod_data(sub.data, nf, fdata.bands)
+        else:
+            test = fdata[idx]
+            ref = rfft(sub.data, nf)
+
+        # run the routines in data stores restricted to the subset
+        stores = []
+        for f in [test, ref]:
+            s = SubsetStore()
+            for r in self._routines:
+                for key in r.inputs.values():
+                    if key not in s and store.get(key) is not None:
+                        s.set(key, subset_dets(store.get(key), idx, ndets))
+            s.set(self.inputs.get('tod'), sub)
+            s.set(self.inputs.get('fft'), dict(fft_data, fdata=f))
+            for r in self._routines:
+                r.execute(s)
+            stores.append(s)
+
+        # compare the features
+        report = {}
+        for r in self._routines:
+            for key in r.outputs.values():
+                test_res, ref_res = [s.get(key) for s in stores]
+                if not isinstance(ref_res, dict):
+                    continue
+                for k in ref_res:
+                    name = "%s.%s" % (key, k)
+                    report[name] = max_rel_deviation(test_res[k], ref_res[k])
+                    if report[name] > self._tolerance:
+                        self.logger.warning("%s deviates by %.1e" % (name, report[name]))
+                    else:
+                        self.logger.info("%s deviates by %.1e" % (name, report[name]))
+
+        store.set(self.outputs.get('precision'), report)
@@ -4,17 +4,33 @@ Loic is using.
 """
 from scipy import signal
 import numpy as np
-from scipy.fftpack import fft
 
 from todloop import Routine
-from .utils import nextregular
+from .utils import nextregular, fft, hann_rfft, BandPowerIndex
 
 
 class JesseFeatures(Routine):
     def __init__(self, **params):
+        """This routine computes the features proposed by Jesse. If an
+        fft input is given, feature 1 and 2 are derived from the shared
+        fourior transform (windowed in frequency space) instead of a
+        second fft of the windowed tod, as long as its length is
+        nextregular(nsamps) so that the bands cover the same frequencies
+
+        Params:
+            validate: compute feature 1 and 2 both ways and report the
+                largest relative difference (requires the fft input)
+
+        If a stats input (from GetDetectorStats, run on the same data) is
+        given, feature 3 and 5 are read from it
+        """
         Routine.__init__(self)
         self.inputs = params.get('inputs')
         self.outputs = params.get('outputs')
+        self._fft_workers = params.get('fft_workers', 1)
+        self._fft_backend = params.get('fft_backend', 'scipy')
+        self._validate = params.get('validate', False)
+        self._block_size = params.get('block_size', 64)
 
     def execute(self, store):
         # retrieve tod from data store
@@ -25,33 +41,55 @@ class JesseFeatures(Routine):
         # compute the feature 1 and 2
         self.logger.info("Computing feature 1 and 2...")
 
-        window = signal.hann(N)
+        fft_data = None
+        if self.inputs.get('fft') is not None:
+            fft_data = store.get(self.inputs.get('fft'))
+            # the bands are fixed bin ranges of an fft of nextregular(N)
+            # samples, another fft length (nf_buckets, fft_size_policy)
+            # puts them at other frequencies
+            if fft_data['nf'] != nextregular(N):
+                self.logger.info("fft length %d differs from %d, computing "
+                                 "feature 1 and 2 from the tod" %
+                                 (fft_data['nf'], nextregular(N)))
+                fft_data = None
 
-        nf = nextregular(N)
-        ywf = np.abs(fft(tod.data*window*2.0/N, nf))
-
-        av = np.mean(ywf, axis=1)
+        if fft_data is not None:
+            pav_low, pav_high = self.get_band_ratios_shared(fft_data['fdata'],
+                                                            fft_data['nf'], N)
+            if self._validate:
+                ref_low, ref_high = self.get_band_ratios(tod.data, N)
+                for name, v, ref in [('feat1', pav_low, ref_low),
+                                     ('feat2', pav_high, ref_high)]:
+                    m = (ref != 0)
+                    dev = np.max(np.abs(v[m]-ref[m])/np.abs(ref[m])) if m.any() else 0
+                    self.logger.info("%s: max relative deviation from the "
+                                     "windowed fft: %.2e" % (name, dev))
+        else:
+            pav_low, pav_high = self.get_band_ratios(tod.data, N)
 
-        # initalize empty array for features
-        pav_low = np.zeros(ndets)
-        pav_high = np.zeros(ndets)
+        # the statistics are read from GetDetectorStats if given
+        if self.inputs.get('stats') is not None:
+            stats = store.get(self.inputs.get('stats'))
+        else:
+            stats = {'head_tail': {}}
 
-        # non-zero mask
-        m = (av != 0)
-        pav_low[m] = np.mean(ywf[m, :1000], axis=1) / av[m]
-        pav_high[m] = np.mean(ywf[m, 1100:3000], axis=1) / av[m]
-        
         # compute the feature 3: rms 
         self.logger.info("Computing feature 3...")
-        rmx = np.std(tod.data, axis=1)
+        if 'std' in stats:
+            rmx = stats['std']
+        else:
+            rmx = np.std(tod.data, axis=1)
 
         # compute the feature 5: a 60 secs feature that jesse proposed
         self.logger.info("Computing feature 5...")        
-        # here we need to take into account that tod may be
-        # down-sampled beforehand
-        ds = tod.info.downsample_level
-        shift = int(24280 / ds)
-        ff5 = np.mean(tod.data[:,:shift]-tod.data[:,-shift:], axis=1)
+        if 24280 in stats['head_tail']:
+            ff5 = stats['head_tail'][24280]
+        else:
+            # here we need to take into account that tod may be
+            # down-sampled beforehand
+            ds = tod.info.downsample_level
+            shift = int(24280 / ds)
+            ff5 = np.mean(tod.data[:,:shift]-tod.data[:,-shift:], axis=1)
 
         # summarize the features into a dictionary 
         results = {
@@ -66,3 +104,190 @@ class JesseFeatures(Routine):
             
         # share the results in the data store
         store.set(self.outputs.get('results'), results)
+
+    def get_band_ratios(self, data, N):
+        """Feature 1 and 2: mean amplitude of the hann-windowed spectrum
+        in two bands relative to its mean over all frequencies"""
+        ndets = data.shape[0]
+        window = signal.windows.hann(N)
+
+        nf = nextregular(N)
+        ywf = np.abs(fft(data*window*2.0/N, nf, workers=self._fft_workers,
+                         backend=self._fft_backend, overwrite_x=True))
+
+        av = np.mean(ywf, axis=1)
+
+        # initalize empty array for features
+        pav_low = np.zeros(ndets)
+        pav_high = np.zeros(ndets)
+
+        # non-zero mask
+        m = (av != 0)
+        pav_low[m] = np.mean(ywf[m, :1000], axis=1) / av[m]
+        pav_high[m] = np.mean(ywf[m, 1100:3000], axis=1) / av[m]
+        return pav_low, pav_high
+
+    def get_band_ratios_shared(self, fdata, nf, N):
+        """Same as get_band_ratios but from the rfft of the tod. The
+        window is applied in frequency space, and the mean over the full
+        (two-sided) spectrum uses |Y[nf-k]| = |Y[k]|"""
+        ndets = fdata.shape[0]
+        av = np.zeros(ndets)
+        low = np.zeros(ndets)
+        high = np.zeros(ndets)
+
+        # bins counted twice in the two-sided spectrum
+        nbins = fdata.shape[1]
+        twice = slice(1, nbins-1 if nf % 2 == 0 else nbins)
+
+        for i in range(0, ndets, self._block_size):
+            ywf = hann_rfft(fdata[i:i+self._block_size, :], nf)*2.0/N
+            index = BandPowerIndex(ywf, power=1)
+            av[i:i+self._block_size] = (index.sum(0, nbins) +
+                                        index.sum(twice.start, twice.stop))/nf
+            low[i:i+self._block_size] = index.mean(0, 1000)
+            high[i:i+self._block_size] = index.mean(1100, 3000)
+
+        # initalize empty array for features
+        pav_low = np.zeros(ndets)
+        pav_high = np.zeros(ndets)
+
+        # non-zero mask
+        m = (av != 0)
+        pav_low[m] = low[m] / av[m]
+        pav_high[m] = high[m] / av[m]
+        return pav_low, pav_high
+
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        return [(0, None)]
+
+
+class LogBinnedPSD(Routine):
+    def __init__(self, **params):
+        """This routine computes a compact spectral product: the power
+        spectral density of each detector averaged in log-spaced
+        frequency bins, in one vectorized pass over the fft data
+
+        Params:
+            nbins: number of frequency bins
+            fmin: lower edge of the first bin in Hz (0.01 by default)
+            fmax: upper edge of the last bin in Hz (50 by default, None
+                for the nyquist frequency). The edges are fixed in Hz so
+                that the bins of different tods line up
+        Outputs:
+            psd:
+                psd: power spectral density (ndet x nbins)
+                freqs: center frequency of the bins
+        """
+        Routine.__init__(self)
+        self.inputs = params.get('inputs')
+        self.outputs = params.get('outputs')
+        self._nbins = params.get('nbins', 50)
+        self._fmin = params.get('fmin', 0.01)
+        self._fmax = params.get('fmax', 50.)
+        self._block_size = params.get('block_size', 64)
+
+    def execute(self, store):
+        tod = store.get(self.inputs.get('tod'))
+        fft_data = store.get(self.inputs.get('fft'))
+        fdata = fft_data['fdata']
+        df = fft_data['df']
+        dt = fft_data['dt']
+        ndets = fdata.shape[0]
+
+        self.logger.info("Computing log-binned psd...")
+        edges = self.get_edges(df, fdata.shape[1])
+        n_l, n_h = edges[0], edges[-1]
+        counts = np.diff(edges)
+
+        # average |fft|^2 in each bin
+        psd = np.zeros((ndets, self._nbins))
+        for i in range(0, ndets, self._block_size):
+            power = np.abs(fdata[i:i+self._block_size, n_l:n_h])**2
+            psd[i:i+self._block_size] = np.add.reduceat(power, edges[:-1]-n_l,
+                                                        axis=1) / counts
+
+        # one-sided psd normalization
+        psd *= 2.*dt/tod.nsamps
+
+        # geometric center of the bins
+        freqs = np.sqrt(edges[:-1]*(edges[1:]-1.))*df
+
+        results = {
+            'psd': psd,
+            'freqs': freqs,
+        }
+        store.set(self.outputs.get('psd'), results)
+
+    def get_edges(self, df, nbins_total):
+        """Index of the first frequency of each bin, and the (exclusive)
+        end of the last bin"""
+        fmin = self._fmin if self._fmin is not None else df
+        fmax = self._fmax if self._fmax is not None else (nbins_total-1)*df
+        edges = np.round(np.geomspace(fmin, fmax, self._nbins+1)/df).astype(int)
+        edges[0] = max(edges[0], 1)
+
+        # make sure that every bin has at least one frequency
+        for i in range(1, len(edges)):
+            edges[i] = max(edges[i], edges[i-1]+1)
+        if edges[-1] > nbins_total:
+            raise ValueError("not enough frequencies for %d bins" % self._nbins)
+        return edges
+
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        if self._fmax is None:
+            # the range extends to nyquist
+            fmin = self._fmin if self._fmin is not None else df
+            return [(max(int(round(fmin/df)), 1), None)]
+        edges = self.get_edges(df, np.inf)
+        return [(edges[0], edges[-1])]
+
+
+class BandPowerFeatures(Routine):
+    def __init__(self, **params):
+        """This routine computes the mean power of each detector in a
+        list of named frequency bands. The power is read from a
+        BandPowerIndex (cumulative power spectrum), so each band costs
+        one subtraction. The index is built from the fft data, over the
+        requested bands only, unless an index input is given, and can be
+        shared through the index output
+
+        Params:
+            bands: dictionary of feature name: [fmin, fmax] in Hz
+            normalize: divide the band powers by nsamps so that they are
+                in the same units as the rms-like features
+        """
+        Routine.__init__(self)
+        self.inputs = params.get('inputs')
+        self.outputs = params.get('outputs')
+        self._bands = params.get('bands', {})
+        self._normalize = params.get('normalize', True)
+
+    def execute(self, store):
+        tod = store.get(self.inputs.get('tod'))
+
+        # retrieve or build the band power index
+        if self.inputs.get('index') is not None:
+            index = store.get(self.inputs.get('index'))
+        else:
+            fft_data = store.get(self.inputs.get('fft'))
+            index = BandPowerIndex(fft_data['fdata'], df=fft_data['df'],
+                                   bands=self.freq_bins(fft_data['df']))
+            if self.outputs.get('index') is not None:
+                store.set(self.outputs.get('index'), index)
+
+        self.logger.info("Computing band powers...")
+        results = {}
+        for name, (fmin, fmax) in self._bands.items():
+            results[name] = index.band_mean(fmin, fmax)
+            if self._normalize:
+                results[name] /= tod.nsamps
+
+        store.set(self.outputs.get('results'), results)
+
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        return [(int(round(fmin/df)), int(round(fmax/df)))
+                for fmin, fmax in self._bands.values()]
@@ -116,7 +116,17 @@ class PrepareDataLabel(Routine):
 class PrepareDataLabelNew(Routine):
     def __init__(self, **params):
         """Prepare an HDF5 data set that contains all relevant metedata
-        and detector timeseries as a basis for various ML studies
+        and detector timeseries as a basis for various ML studies. If a
+        psd input (from LogBinnedPSD) is given, each detector gets its
+        log psd relative to the median of the live detectors as the
+        'psd' attribute (bin frequencies in Hz in the 'psd_freqs'
+        attribute) instead of the truncated fft stacked with its
+        timeseries. If a cc input (cc_live from AnalyzeLiveLF with
+        ccRank > 0) is given, each detector gets its low rank correlation
+        factor as the 'ccFactor' attribute (window bounds in Hz in the
+        'cc_windows' attribute), from which rebuild_cc gives the
+        correlation matrices of any set of detectors. The frequencies
+        depend on the tod, so they are stored with each detector
         """
         Routine.__init__(self)
         self.inputs = params.get("inputs", None)
@@ -153,7 +163,14 @@ class PrepareDataLabelNew(Routine):
     def execute(self, store):
         # retrieve tod data
         tod = store.get(self.inputs.get('tod'))
-        fft = store.get(self.inputs.get('fft'))['fdata']
+
+        # retrieve the spectral data: either a log-binned psd product or
+        # the raw fft
+        if self.inputs.get('psd') is not None:
+            psd = store.get(self.inputs.get('psd'))
+        else:
+            psd = None
+            fft = store.get(self.inputs.get('fft'))['fdata']
 
         # retrieve the calculated statistics
         report = store.get(self.inputs.get('report'))
@@ -166,6 +183,14 @@ class PrepareDataLabelNew(Routine):
             for k in keys:
                 report[k] -= np.mean(report[k])
 
+        # retrieve the low rank correlation factors if needed
+        if self.inputs.get('cc') is not None:
+            cc = store.get(self.inputs.get('cc'))
+            # the windows are index ranges of this tod's spectrum
+            cc_windows = np.asarray(cc['windows'])*cc['df']
+        else:
+            cc = None
+
         # get relevant metadata for this tod from pickle file
         tod_name = self.get_name()
         pickle_id = self._pickle_data['name'].index(tod_name)
@@ -175,15 +200,23 @@ class PrepareDataLabelNew(Routine):
         live_dets = list(np.where(live == 1))[0]
 
         # treat the median as the common modes
-        fdata_cm = np.median(np.abs(fft[live_dets, :self._truncate]), axis=0)
+        if psd is not None:
+            # the psd is compared in log space
+            lpsd = np.log10(psd['psd'][live_dets])
+            lpsd -= np.median(lpsd, axis=0)
+        else:
+            fdata_cm = np.median(np.abs(fft[live_dets, :self._truncate]), axis=0)
 
         # store each det timeseries in hdf5
-        for tes_det in live_dets:
+        for i, tes_det in enumerate(live_dets):
             tdata = tod.data[tes_det, ::self._downsample][400:400+self._truncate]
-            fdata = np.abs(fft[tes_det, :self._truncate])
-            fdata -= fdata_cm
+            if psd is not None:
+                data = tdata
+            else:
+                fdata = np.abs(fft[tes_det, :self._truncate])
+                fdata -= fdata_cm
 
-            data = np.vstack([tdata, fdata])
+                data = np.vstack([tdata, fdata])
 
             # generate a unique detector id
             det_uid = '%s.%d' % (self.get_name(), tes_det)
@@ -199,11 +232,27 @@ class PrepareDataLabelNew(Routine):
             for k in keys:
                 dataset.attrs[k] = report[k][tes_det]
 
+            # save the log psd relative to the common mode
+            if psd is not None:
+                dataset.attrs['psd'] = lpsd[i]
+                dataset.attrs['psd_freqs'] = psd['freqs']
+
+            # save the correlation factor of the detector
+            if cc is not None:
+                dataset.attrs['ccFactor'] = cc['factor'][tes_det]
+                dataset.attrs['cc_windows'] = cc_windows
+
             # save label
             dataset.attrs['label'] = int(self._pickle_data['sel'][tes_det, pickle_id])
 
         self.logger.info("Data saved in %s" % self._output_file)
 
+    def freq_bins(self, df):
+        """Frequency index ranges read by this routine"""
+        if self.inputs.get('psd') is not None:
+            return []
+        return [(0, self._truncate)]
+
     def finalize(self):
         self._hf.close()
 
@@ -1,3 +1,4 @@
+import os, hashlib
 import numpy as np
 
 import moby2
@@ -9,9 +10,66 @@ from .utils import *
 
 class FouriorTransform(Routine):
     def __init__(self, **params):
+        """This routine detrends the tod and computes its fourior
+        transform. Optionally the fft data can be cached on disk, in
+        which case a later run with the same tod and the same
+        cache_params maps the cached spectrum back instead of
+        recomputing it
+
+        Params:
+            cache_dir: directory to cache fft data in (None to disable)
+            cache_params: parameters of the upstream preprocessing that
+                determine the spectrum, they are hashed into the cache key.
+                They must include every parameter of the routines that
+                modify the tod before this one (TransformTOD, the cuts,
+                the calibration...), a change that is not reflected in
+                them reads back a stale spectrum
+            bands: if given only these frequency bands of the spectrum are
+                kept. Each entry is either a routine that declares the
+                bands it reads with freq_bins(df), or a (fmin, fmax) tuple
+                in Hz. The spectrum is then stored as a BandedSpectrum
+            engine: 'rfft' (default) to slice the bands out of the full
+                transform of each block of detectors, or 'decimate' to
+                compute them with BandDecimator if they are all narrow
+                enough (requires bands). This is only faster for a single
+                narrow band in double precision
+            fft_workers: number of threads used by the fft (-1 for all)
+            fft_backend: 'scipy' (default) or 'numpy'
+            block_size: number of detectors transformed at a time, this
+                bounds the memory used on top of the output
+            dtype: 'complex128' (default) or 'complex64' for the output,
+                the analysis routines then work in single precision (see
+                CheckPrecision)
+            fft_size_policy: how the fft length is chosen, see
+                FFTSizePlanner ('regular' by default)
+            fft_timings: json file of fft timings written by
+                FFTSizePlanner.save_timings, for the 'benchmark' policy
+            nf_buckets: round the fft length up to canonical lengths,
+                either a list of lengths or a relative step (see
+                FFTSizePlanner.get_bucket)
+            reuse_buffers: reuse the memory of the spectrum of the
+                previous tod instead of allocating a new one
+        """
         Routine.__init__(self)
         self.inputs = params.get('inputs', None)
         self.outputs = params.get('outputs', None)
+        self._cache_dir = params.get('cache_dir', None)
+        self._cache_params = params.get('cache_params', {})
+        self._bands = params.get('bands', None)
+        self._engine = params.get('engine', 'rfft')
+        self._fft_workers = params.get('fft_workers', 1)
+        self._fft_backend = params.get('fft_backend', 'scipy')
+        self._block_size = params.get('block_size', 64)
+        self._dtype = np.dtype(params.get('dtype', 'complex128'))
+        self._planner = FFTSizePlanner(policy=params.get('fft_size_policy', 'regular'),
+                                       backend=self._fft_backend,
+                                       timings=params.get('fft_timings', None),
+                                       buckets=params.get('nf_buckets', None))
+        self._pool = BufferPool() if params.get('reuse_buffers', False) else None
+
+    def initialize(self):
+        if self._cache_dir is not None and not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
 
     def execute(self, store):
         tod = store.get(self.inputs.get('tod'))
@@ -20,23 +78,65 @@ class FouriorTransform(Routine):
         self.logger.info('Detrend the tod...')
         trend = moby2.tod.detrend_tod(tod)
 
-        # find the next regular, this is to make fft faster
-        self.logger.info('Perform fft on the tod...')
-        nf = nextregular(tod.nsamps)
-        fdata = np.fft.rfft(tod.data, nf)
+        # find a size that makes fft faster
+        nf = self._planner.next_size(tod.nsamps)
 
         # time and freq units
         dt = (tod.ctime[-1]-tod.ctime[0])/(tod.nsamps-1)
         df = 1./(dt*nf)
 
-        # summarize fft data
-        fft_data = {
-            'trend': trend,
-            'fdata': fdata,
-            'dt': dt,
-            'df': df,
-            'nf': nf
-        }
+        # find the frequency bands to keep
+        bins = None
+        if self._bands is not None:
+            bins = get_freq_bins(self._bands, df, nf//2+1)
+
+        # look for a cached spectrum of this tod
+        fft_data = None
+        if self._cache_dir is not None:
+            cache_path = os.path.join(self._cache_dir, spectrum_cache_key(
+                self.get_name(), {'upstream': self._cache_params,
+                                  'bands': bins,
+                                  'dtype': self._dtype.name}))
+            fft_data = load_spectrum(cache_path)
+            # make sure that the cached spectrum matches the tod
+            if fft_data is not None and (fft_data['nf'] != nf or
+               fft_data['fdata'].shape[0] != tod.data.shape[0]):
+                self.logger.warning('Cached fft data does not match the tod, ignored')
+                fft_data = None
+            if fft_data is not None:
+                self.logger.info('Loaded fft data from %s' % cache_path)
+
+        if fft_data is None:
+            if bins is not None:
+                # compute only the bands that will be used
+                self.logger.info('Perform %s on freqs %s' % (self._engine, bins))
+                fdata = BandedSpectrum.from_tod_data(
+                    tod.data, nf, bins, dtype=self._dtype,
+                    block_size=self._block_size, pool=self._pool,
+                    engine=self._engine,
+                    workers=self._fft_workers, backend=self._fft_backend)
+            else:
+                self.logger.info('Perform fft on the tod...')
+                shape = (tod.data.shape[0], nf//2+1)
+                if self._pool is not None:
+                    fdata = self._pool.get('fdata', shape, self._dtype)
+                else:
+                    fdata = np.empty(shape, dtype=self._dtype)
+                rfft(tod.data, nf, out=fdata, block_size=self._block_size,
+                     workers=self._fft_workers, backend=self._fft_backend)
+
+            # summarize fft data
+            fft_data = {
+                'trend': trend,
+                'fdata': fdata,
+                'dt': dt,
+                'df': df,
+                'nf': nf
+            }
+
+            if self._cache_dir is not None:
+                save_spectrum(cache_path, fft_data)
+                self.logger.info('fft data cached in %s' % cache_path)
 
         # store data into data store
         store.set(self.outputs.get('tod'), tod)
@@ -47,7 +147,35 @@ class FouriorTransform(Routine):
 class TransformTOD(Routine):
     def __init__(self, **params):
         """This routine transforms a series of tod data transformation
-        such as downsampling, remove_mean and detrend"""
+        such as downsampling, remove_mean and detrend
+
+        Params:
+            fused: apply all the transformations to a block of detectors
+                at a time, decimating it into a compact buffer right away,
+                instead of one pass over the whole tod per transformation
+            block_bytes: size of the blocks of detectors transformed at a
+                time (1 MB by default, to stay in the L2 cache)
+            block_size: number of detectors per block, overrides
+                block_bytes
+            downsample_inplace: decimate the data into the memory of the
+                original samples, which is shrunk right away, instead of
+                making a downsampled copy of the samples. The data is
+                taken away from the input tod
+            antialias: low-pass filter the data (polyphase filter) before
+                decimating it
+            n_downsample: downsample the tod by 2**n_downsample, or 'auto'
+                to pick the largest n that keeps the highest frequency
+                read by the bands below the new nyquist frequency divided
+                by downsample_margin. The data is then always anti-aliased
+            bands: the frequency bands used downstream, as for
+                FouriorTransform: routines that declare the bands they
+                read with freq_bins(df), or (fmin, fmax) tuples in Hz.
+                Only the bands given here are protected, time domain
+                consumers have to be accounted for with a tuple
+            downsample_margin: guard factor of 'auto' (1.5 by default, the
+                anti-aliasing filter is flat within 0.2% up to 0.8 of the
+                new nyquist frequency)
+        """
         Routine.__init__(self)
         self.inputs = params.get('inputs', None)
         self.outputs = params.get('outputs', None)
@@ -56,11 +184,28 @@ class TransformTOD(Routine):
         self._detrend = params.get('detrend', True)
         self._remove_filter_gain = params.get('remove_filter_gain', False)
         self._n_downsample = params.get('n_downsample', None)
+        self._fused = params.get('fused', False)
+        self._block_size = params.get('block_size', None)
+        self._block_bytes = params.get('block_bytes', 2**20)
+        self._downsample_inplace = params.get('downsample_inplace', False)
+        self._antialias = params.get('antialias', False)
+        self._bands = params.get('bands', None)
+        self._downsample_margin = params.get('downsample_margin', 1.5)
 
     def execute(self, store):
         # retrieve tod
         tod = store.get(self.inputs.get('tod'))
 
+        # find the downsample level
+        n_downsample, antialias = self._n_downsample, self._antialias
+        if n_downsample == 'auto':
+            n_downsample, antialias = self.get_downsample_level(tod), True
+
+        if self._fused:
+            tod = self.fused_transform(tod, n_downsample, antialias)
+            store.set(self.outputs.get('tod'), tod)
+            return
+
         # remove mean or remove median
         if self._remove_mean:
             moby2.tod.remove_mean(tod)
@@ -76,15 +221,165 @@ class TransformTOD(Routine):
             moby2.tod.remove_filter_gain(tod)
 
         # downsampling
-        if self._n_downsample is not None:
-            tod = tod.copy(resample=2**self._n_downsample, resample_offset=1)
-            self.logger.info("Downsampling done")
+        if n_downsample is not None:
+            if self._downsample_inplace or antialias:
+                tod = self.downsample(tod, n_downsample, antialias)
+            else:
+                tod = tod.copy(resample=2**n_downsample, resample_offset=1)
+                self.logger.info("Downsampling done")
 
         store.set(self.outputs.get('tod'), tod)
 
+    def fused_transform(self, tod, n_downsample, antialias):
+        """Same transformations as execute but in a single pass over the
+        data: each block of detectors goes through all of them and is then
+        decimated right away. The blocks are sized by block_bytes so that
+        they stay in cache between the steps, a detector longer than that
+        is a block on its own. The transformations are per detector so
+        the results are the same"""
+        # the filter gain is the same for all detectors
+        if self._remove_filter_gain:
+            gain = tod.info.mce_filter.gain()
+
+        def transform(block):
+            # remove mean or remove median
+            if self._remove_mean:
+                moby2.tod.remove_mean(data=block)
+            elif self._remove_median:
+                moby2.tod.remove_median(data=block)
+
+            # detrend
+            if self._detrend:
+                moby2.tod.detrend_tod(data=block)
+
+            # remove filter gain
+            if self._remove_filter_gain:
+                block /= gain
+
+        return self.downsample(tod, n_downsample, antialias, transform=transform)
+
+    def downsample(self, tod, n_downsample, antialias, transform=None):
+        """Decimate the tod by 2**n_downsample (with the sample offset of
+        tod.copy), optionally applying transform to each block of
+        detectors first. The decimated data goes into a new compact
+        buffer, or with downsample_inplace replaces the original samples
+        in their own memory (the input tod is then left without data).
+        The metadata of the returned tod is resampled by tod.copy"""
+        if n_downsample is None:
+            resample, offset = 1, 0
+        else:
+            resample, offset = 2**n_downsample, 1
+
+        block_size = self._block_size
+        if block_size is None:
+            block_size = cache_block_size(tod.data, self._block_bytes)
+        self.logger.info("Processing the tod in blocks of %d detectors" % block_size)
+
+        out = None
+        if resample > 1 and not self._downsample_inplace:
+            ndet, nsamps = tod.data.shape
+            out = np.empty((ndet, len(range(offset, nsamps, resample))),
+                           dtype=tod.data.dtype)
+
+        if resample > 1 and out is None:
+            # hand the only reference to the samples over so that their
+            # memory can be shrunk in place, the original tod is left
+            # without data
+            data = downsample_rows(detach_data(tod), resample, offset,
+                                   antialias=antialias, block_size=block_size,
+                                   transform=transform)
+        else:
+            data = downsample_rows(tod.data, resample, offset,
+                                   antialias=antialias, block_size=block_size,
+                                   out=out, transform=transform)
+
+        if resample > 1:
+            tod = resample_tod(tod, data, resample, offset)
+            self.logger.info("Downsampling done")
+
+        return tod
+
+    def get_downsample_level(self, tod):
+        """Largest downsample level (None for no downsampling) at which
+        the highest frequency of the bands stays below the nyquist
+        frequency divided by the guard margin"""
+        if self._bands is None:
+            raise ValueError("n_downsample='auto' requires the bands parameter")
+        nsamps = tod.nsamps
+        dt = (tod.ctime[-1]-tod.ctime[0])/(nsamps-1)
+        df = 1./(dt*nsamps)
+        nbins = nsamps//2+1
+        bins = get_freq_bins(self._bands, df, nbins)
+        if len(bins) == 0:
+            self.logger.warning("No frequency bands found, not downsampling")
+            return None
+
+        # the band stops are exclusive, nyquist is at nbins-1
+        fmax = (bins[-1][1]-1)*df
+        fnyq = 0.5/dt
+        if fmax <= 0:
+            return None
+        n = int(np.floor(np.log2(fnyq/(self._downsample_margin*fmax))))
+        self.logger.info("Highest frequency %.2f Hz, downsample level %d" % (fmax, max(n, 0)))
+        if n <= 0:
+            return None
+        return n
+
+
+class GetDetectorStats(Routine):
+    def __init__(self, **params):
+        """This routine computes the per detector statistics that the
+        other routines need (mean, var, std, min, max, zero, constant and
+        head / tail differences) in one pass over the tod, in blocks of
+        detectors that stay in cache, and shares them in the data store.
+        The statistics describe the data as it is when this routine runs,
+        so a consumer should only read them if the data has not been
+        modified since (e.g. CalibrateTOD or the detrending of
+        FouriorTransform)
+
+        Params:
+            block_bytes: size of the blocks of detectors (1 MB by default)
+            block_size: number of detectors per block, overrides
+                block_bytes
+            zero_stride: sample stride of the zero check
+            windows: head / tail window lengths in samples of the original
+                sampling rate, they are scaled by the downsample level as
+                in JesseFeatures
+        """
+        Routine.__init__(self)
+        self.inputs = params.get('inputs', None)
+        self.outputs = params.get('outputs', None)
+        self._block_size = params.get('block_size', None)
+        self._block_bytes = params.get('block_bytes', 2**20)
+        self._zero_stride = params.get('zero_stride', 100)
+        self._windows = params.get('windows', [24280])
+
+    def execute(self, store):
+        tod = store.get(self.inputs.get('tod'))
+
+        # window lengths at the current sampling rate
+        ds = tod.info.downsample_level
+        windows = dict((n, int(n / ds)) for n in self._windows)
+
+        self.logger.info("Computing detector statistics...")
+        stats = get_detector_stats(tod.data, block_bytes=self._block_bytes,
+                                   block_size=self._block_size,
+                                   zero_stride=self._zero_stride,
+                                   windows=list(windows.values()))
+
+        # key the head / tail differences by the original window lengths
+        stats['head_tail'] = dict((n, stats['head_tail'][w])
+                                  for n, w in windows.items())
+        stats['nsamps'] = tod.nsamps
+
+        store.set(self.outputs.get('stats'), stats)
+
 
 class GetDetectors(Routine):
     def __init__(self, **params):
+        """This routine selects the live and dark detectors. The detector
+        lists are read once in initialize, and their masks are cached
+        for each array layout (det_uid, and row / col for matrix lists)"""
         Routine.__init__(self)
         self.inputs = params.get('inputs', None)
         self.outputs = params.get('outputs', None)
@@ -95,6 +390,12 @@ class GetDetectors(Routine):
         self._dark = params.get('dark', None)
         self._exclude = params.get('exclude', None)
         self._noExclude = params.get('noExclude', False)
+        self._masks = {}
+
+    def initialize(self):
+        # retrieve predefined exclude, dark live detector lists from file,
+        # they are the same for all tods
+        self._lists = self.get_detector_params()
 
     def execute(self, store):
         # get tod
@@ -105,24 +406,8 @@ class GetDetectors(Routine):
         # i think it might be just a safety precaution
         dets = tod.info.det_uid.copy()
 
-        # retrieve predefined exclude, dark live detector lists from file
-        _exclude, _dark, _live = self.get_detector_params()
-
         # create mask based on the provided lists
-
-        # look at the exclude detector list
-        # if the given list is based on individual source
-        if 'det_uid' in _exclude:
-            exclude = tod.info.array_data.select_inner({
-                'det_uid': _exclude['det_uid']
-            }, mask = True, det_uid = dets)
-            
-        # if the given list is based on matrix source
-        else:
-            exclude = tod.info.array_data.select_inner({
-                'row': _exclude['rows'],
-                'col': _exclude['cols']
-            }, mask = True, det_uid = dets)
+        exclude, dark_candidates, live_candidates = self.get_masks(tod, dets)
 
         # noExclude parameter specifies if we want to remove
         # the detectors that are cutted beforehand, if it's
@@ -132,42 +417,24 @@ class GetDetectors(Routine):
         if not(self._noExclude):
             exclude[list(tod.cuts.get_cut())] = True
 
-        # look at dark detector list
-        # if the list is based on individual source
-        if 'det_uid' in _dark:
-            dark_candidates = tod.info.array_data.select_inner({
-                'det_uid': _dark['det_uid']
-            }, mask = True, det_uid = dets)
-            
-        # if the list is based on matrix source
+        # the statistics are read from GetDetectorStats if given
+        if self.inputs.get('stats') is not None:
+            stats = store.get(self.inputs.get('stats'))
         else:
-            dark_candidates = tod.info.array_data.select_inner({
-                'row': _dark['rows'],
-                'col': _dark['cols']
-            }, mask = True, det_uid = dets)
-
-        # look at the live detector lists
-        # if the list is based on individual source
-        if 'det_uid' in _live:
-            live_candidates = tod.info.array_data.select_inner({
-                'det_uid': _live['det_uid']
-            }, mask = True, det_uid = dets)
-            
-        # if the list is based on matrix source
-        else:
-            live_candidates = tod.info.array_data.select_inner({
-                'row': _live['rows'],
-                'col': _live['cols']
-            }, mask = True, det_uid = dets)
-    
-        # filter zero detectors
-        # mark zero detectors as 1, otherwise 0 
+            stats = None
+
         self.logger.info('Finding zero detectors')
-        zero_sel = ~tod.data[:,::100].any(axis=1)
+        if stats is not None:
+            zero_sel = stats['zero']
+        else:
+            zero_sel = ~tod.data[:,::100].any(axis=1)
 
         # filter detectors with too large rms
         # mark good detectors as 1 and bad (large rms) as 0
-        full_rms_sel = np.std(tod.data, axis=1) < self._fullRMSlim
+        if stats is not None:
+            full_rms_sel = stats['std'] < self._fullRMSlim
+        else:
+            full_rms_sel = np.std(tod.data, axis=1) < self._fullRMSlim
 
         # exclude zero detectors and noisy detectors
         live = live_candidates * ~zero_sel * full_rms_sel
@@ -214,10 +481,51 @@ class GetDetectors(Routine):
             liveCandidates = moby2.util.MobyDict.from_file(self._live)
             
         else:
-            raise "Unknown detector params source"
+            raise ValueError("Unknown detector params source")
         
         return exclude, dark, liveCandidates        
 
+    def get_masks(self, tod, dets):
+        """Masks of the exclude, dark and live lists for the detectors
+        dets, cached by the hash of the detector layout"""
+        # rows and cols are only needed for the lists in matrix form
+        rows = cols = None
+        h = hashlib.sha1(np.ascontiguousarray(dets).tobytes())
+        if any('det_uid' not in l for l in self._lists):
+            array_data = tod.info.array_data
+            # vectorized det_uid to index lookup
+            uids = np.asarray(array_data['det_uid'])
+            order = np.argsort(uids)
+            idx = order[np.searchsorted(uids, dets, sorter=order)]
+            rows = np.asarray(array_data['row'])[idx].astype(np.int64)
+            cols = np.asarray(array_data['col'])[idx].astype(np.int64)
+            h.update(rows.tobytes())
+            h.update(cols.tobytes())
+        key = h.hexdigest()
+
+        if key not in self._masks:
+            self.logger.info("Creating the detector masks")
+            self._masks[key] = [self.select_dets(l, dets, rows, cols)
+                                for l in self._lists]
+
+        # copy so that the cached masks are not modified
+        return [m.copy() for m in self._masks[key]]
+
+    @staticmethod
+    def select_dets(dlist, dets, rows, cols):
+        """Mask of the detectors dets in the list dlist, given either by
+        det_uid or by (rows, cols) pairs"""
+        # if the given list is based on individual source
+        if 'det_uid' in dlist:
+            return np.isin(dets, np.asarray(dlist['det_uid']))
+
+        # if the given list is based on matrix source, match the
+        # (row, col) pairs through a single integer key
+        lrows = np.asarray(dlist['rows'], dtype=np.int64)
+        lcols = np.asarray(dlist['cols'], dtype=np.int64)
+        ncols = max(cols.max(initial=0), lcols.max(initial=0)) + 1
+        return np.isin(rows*ncols + cols, lrows*ncols + lcols)
+
 
 class CalibrateTOD(Routine):
     def __init__(self, **params):
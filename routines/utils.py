@@ -1,9 +1,194 @@
 from __future__ import division
+import os, json, time, shutil, hashlib, bisect, copy
 import numpy as np
+from scipy.signal import resample_poly
+from scipy import special
+import scipy.linalg
+
+# scipy.fft (scipy >= 1.4) supports multi-threaded transforms, fall back
+# to numpy if it's not available
+try:
+    from scipy import fft as sp_fft
+except ImportError:
+    sp_fft = None
+
+def rfft(data, n=None, out=None, workers=1, backend='scipy', block_size=64):
+    """Real fft of a 2d array (ndet x nsamps) along the last axis,
+    zero-padded to n samples. The result is written into out, which is
+    allocated as complex128 if not given, block_size rows at a time so
+    that the temporaries stay small. Each block is converted to the
+    precision of out in a private copy that the scipy backend is allowed
+    to overwrite, and transformed on the given number of workers
+    (threads, -1 for all cores)"""
+    if n is None:
+        n = data.shape[-1]
+    if out is None:
+        out = np.empty((data.shape[0], n//2+1), dtype=np.complex128)
+    real = np.float32 if out.dtype == np.complex64 else np.float64
+    for i in range(0, data.shape[0], block_size):
+        x = np.array(data[i:i+block_size], dtype=real)
+        if backend == 'scipy' and sp_fft is not None:
+            out[i:i+block_size] = sp_fft.rfft(x, n, workers=workers,
+                                              overwrite_x=True)
+        else:
+            out[i:i+block_size] = np.fft.rfft(x, n)
+    return out
+
+
+def fft(data, n=None, workers=1, backend='scipy', overwrite_x=False):
+    """Complex fft along the last axis, zero-padded to n samples,
+    with the same backends as rfft"""
+    if backend == 'scipy' and sp_fft is not None:
+        return sp_fft.fft(data, n, workers=workers, overwrite_x=overwrite_x)
+    else:
+        return np.fft.fft(data, n)
+
+
+def irfft(fdata, n=None, workers=1, backend='scipy', overwrite_x=False):
+    """Inverse of rfft along the last axis, with the same backends"""
+    if backend == 'scipy' and sp_fft is not None:
+        return sp_fft.irfft(fdata, n, workers=workers, overwrite_x=overwrite_x)
+    else:
+        return np.fft.irfft(fdata, n)
+
+
+def hann_rfft(fdata, nf):
+    """Apply a (periodic) Hann window of length nf to a signal given by
+    its rfft (last axis, zero-padded to nf samples). In frequency space
+    the window is the 3-tap convolution 0.5 X[k] - 0.25 (X[k-1] + X[k+1]),
+    the bins outside of the rfft range follow from X[-k] = conj(X[k])"""
+    fdata = np.asarray(fdata)
+    wdata = 0.5*fdata
+    wdata[..., 1:] -= 0.25*fdata[..., :-1]
+    wdata[..., :-1] -= 0.25*fdata[..., 1:]
+    wdata[..., 0] -= 0.25*np.conj(fdata[..., 1])
+    # X[nf//2+1] = conj(X[nf//2-1]) for even nf, conj(X[nf//2]) for odd nf
+    wdata[..., -1] -= 0.25*np.conj(fdata[..., -2 if nf % 2 == 0 else -1])
+    return wdata
+
+
+def smooth_numbers(limit, primes):
+    """Sorted list of the numbers up to limit whose prime factors are
+    all in primes"""
+    nums = [1]
+    for p in primes:
+        new = []
+        for x in nums:
+            while x <= limit:
+                new.append(x)
+                x *= p
+        nums = new
+    return sorted(nums)
+
+
+class FFTSizePlanner(object):
+    """Picks fft sizes from a precomputed sorted table of smooth numbers
+    (found with a bisect), according to a policy:
+        regular: smallest number >= n with factors in 2, 3, 5, 7, 11, 13
+        fast: smallest size >= n that the backend handles best, i.e.
+            scipy.fft.next_fast_len for scipy, 5-smooth for numpy
+        benchmark: among the regular sizes in [n, n*(1+slack)], the one
+            with the lowest time in a stored micro-benchmark (see
+            measure and save_timings). Falls back to regular for sizes
+            that have not been measured
+    Sizes can further be rounded up to a small set of canonical lengths
+    with buckets, see get_bucket.
+    """
+    PRIMES = {
+        'regular': (2, 3, 5, 7, 11, 13),
+        'numpy': (2, 3, 5),
+    }
+    _tables = {}
+
+    def __init__(self, policy='regular', backend='scipy', timings=None,
+                 slack=0.05, buckets=None):
+        self.policy = policy
+        self.backend = backend
+        self.slack = slack
+        self.buckets = buckets
+        self.timings = {}
+        if isinstance(timings, str):
+            with open(timings, "r") as f:
+                timings = json.load(f)['timings']
+        if timings is not None:
+            self.timings = dict([(int(k), v) for k, v in timings.items()])
+
+    @classmethod
+    def get_table(cls, name, n):
+        """Table of smooth numbers covering at least up to n, shared by
+        all planners and extended when needed"""
+        table = cls._tables.get(name, [])
+        if len(table) == 0 or table[-1] < n:
+            limit = 2**20
+            while limit < n:
+                limit *= 2
+            table = smooth_numbers(2*limit, cls.PRIMES[name])
+            cls._tables[name] = table
+        return table
+
+    def next_regular(self, n, name='regular'):
+        table = self.get_table(name, n)
+        return table[bisect.bisect_left(table, n)]
+
+    def get_bucket(self, n):
+        """Round n up to a canonical length. buckets is either a list of
+        lengths (n is returned if it's larger than all of them), or a
+        relative step, in which case the canonical lengths are the sizes
+        of the policy on a geometric grid 2**m * (1+step)**k"""
+        if isinstance(self.buckets, (list, tuple)):
+            larger = [b for b in self.buckets if b >= n]
+            return min(larger) if len(larger) > 0 else n
+        m = 2**int(np.floor(np.log2(n)))
+        k = int(np.ceil(np.log(n/m)/np.log(1+self.buckets) - 1e-9))
+        return max(int(np.ceil(m*(1+self.buckets)**k)), n)
+
+    def next_size(self, n):
+        """Return the fft size to use for n samples"""
+        if self.buckets is not None:
+            n = self.get_bucket(n)
+        if self.policy == 'fast':
+            if self.backend == 'scipy' and sp_fft is not None:
+                return sp_fft.next_fast_len(n, real=True)
+            return self.next_regular(n, 'numpy')
+        elif self.policy == 'benchmark':
+            table = self.get_table('regular', int(n*(1+self.slack))+1)
+            i0 = bisect.bisect_left(table, n)
+            i1 = bisect.bisect_right(table, n*(1+self.slack))
+            measured = [m for m in table[i0:i1] if m in self.timings]
+            if len(measured) > 0:
+                return min(measured, key=lambda m: self.timings[m])
+        return self.next_regular(n)
+
+    def measure(self, nmin, nmax, ndet=16, repeat=3, workers=1):
+        """Time the real fft of ndet rows for all regular sizes in
+        [nmin, nmax] with the backend of the planner, and store the best
+        time of each size in timings"""
+        table = self.get_table('regular', nmax)
+        sizes = table[bisect.bisect_left(table, nmin):bisect.bisect_right(table, nmax)]
+        out = None
+        for m in sizes:
+            data = np.random.randn(ndet, m)
+            out = np.empty((ndet, m//2+1), dtype=np.complex128)
+            best = np.inf
+            for i in range(repeat):
+                t0 = time.time()
+                rfft(data, m, out=out, workers=workers, backend=self.backend)
+                best = min(best, time.time() - t0)
+            self.timings[m] = best
+        return self.timings
+
+    def save_timings(self, filename):
+        with open(filename, "w") as f:
+            json.dump({'backend': self.backend, 'timings': self.timings}, f)
+
+
+# planner behind nextregular, it's shared by all the call sites that
+# need a regular number rather than a backend specific fft size
+_regular_planner = FFTSizePlanner()
+
 
 def nextregular(n):
-    while not checksize(n): n+=1
-    return n
+    return _regular_planner.next_size(n)
 
 def checksize(n):
     while not (n%16): n//=16
@@ -134,6 +319,305 @@ def group_detectors(cc, sel = None, **kwargs):
     return G, ind, ld, smap    
 
 
+def get_lf_windows(freqRange, df, minFreqElem=16):
+    """Get the [n_l, n_h) index ranges of the low frequency windows
+    described by freqRange (fmin, fshift, band, Nwin)"""
+    fmin = freqRange.get("fmin", 0.017)
+    fshift = freqRange.get("fshift", 0.009)
+    band = freqRange.get("band", 0.070)
+    Nwin = freqRange.get("Nwin", 1)
+
+    windows = []
+    for i in range(Nwin):
+        # lower bound: fmin + [ fshifts ]
+        # upper bound: fmin + band  + [ fshifts ]
+        n_l = int(round((fmin + i*fshift)/df))
+        n_h = int(round((fmin + i*fshift + band)/df))
+
+        # if there are too few elements then add a few more to
+        # have exactly the minimum required
+        if (n_h - n_l) < minFreqElem:
+            n_h = n_l + minFreqElem
+        windows.append((n_l, n_h))
+    return windows
+
+
+def get_common_modes(data, nmodes, method='eigh', oversample=10, niter=4,
+                     seed=0, solver=None, sel=None, key=None):
+    """Find the nmodes main common modes of data (ndet x nfreq), i.e. its
+    top right singular vectors, returned as orthonormal rows. Methods:
+        svd: full svd of the ndet x ndet correlation matrix (the original
+            implementation, O(ndet^3))
+        eigh (default): top nmodes eigenvectors only, of the smaller of
+            the two correlation matrices (data data^H or data^H data)
+        randomized: randomized range finder with niter power iterations
+            on data directly, O(ndet nfreq nmodes). Its accuracy depends
+            on the gap after the nmodes-th mode
+        subspace: block subspace iteration on data directly, iterated to
+            convergence and seeded with the previous solution if key is
+            given, see CommonModeSolver (solver, sel and key are passed
+            to it). The fastest when there is a gap after the nmodes-th
+            mode, otherwise it falls back to eigh
+    bin/validate_common_modes.py checks the methods against svd
+    """
+    ndet, nfreq = data.shape
+    nmodes = min(nmodes, ndet, nfreq)
+    if method == 'subspace':
+        if solver is None:
+            solver = CommonModeSolver()
+        return solver.solve(data, nmodes, sel=sel, key=key)
+    if method == 'svd':
+        c = np.dot(data, data.T.conjugate())
+        u, w, v = np.linalg.svd(c, full_matrices = 0)
+        kernel = v[:nmodes]/np.repeat([np.sqrt(w[:nmodes])],len(c),axis=0).T
+        return np.dot(kernel, data)
+    elif method == 'eigh':
+        if ndet <= nfreq:
+            c = np.dot(data, data.T.conjugate())
+            w, u = scipy.linalg.eigh(c, subset_by_index=[ndet-nmodes, ndet-1])
+            # eigh sorts in ascending order
+            w, u = w[::-1], u[:, ::-1]
+            w[w <= 0] = np.inf
+            return np.dot(u.T.conjugate(), data) / np.sqrt(w)[:, np.newaxis]
+        else:
+            c = np.dot(data.T.conjugate(), data)
+            w, v = scipy.linalg.eigh(c, subset_by_index=[nfreq-nmodes, nfreq-1])
+            return v[:, ::-1].T.conjugate()
+    elif method == 'randomized':
+        rng = np.random.RandomState(seed)
+        omega = rng.randn(nfreq, min(nmodes + oversample, nfreq)).astype(data.dtype)
+        q, _ = np.linalg.qr(np.dot(data, omega))
+        for i in range(niter):
+            q, _ = np.linalg.qr(np.dot(data.T.conjugate(), q))
+            q, _ = np.linalg.qr(np.dot(data, q))
+        _, _, v = np.linalg.svd(np.dot(q.T.conjugate(), data), full_matrices=False)
+        return v[:nmodes]
+    else:
+        raise ValueError("Unknown method %s" % method)
+
+
+class CommonModeSolver(object):
+    """Finds the main common modes of data (ndet x nfreq) by block
+    subspace iteration. The iteration starts from the detector gains of
+    the modes found in the previous calls with the same key (e.g. the
+    array name and the band), which are shared by all solvers. Only the
+    detectors that have been solved for under the key are seeded, the
+    others start at random. The modes change
+    slowly between the frequency windows, the bands and the tods of an
+    array, so a seeded run converges in a few iterations instead of a
+    full decomposition. If the iteration doesn't converge within maxiter
+    iterations, which happens when there is no gap after the nmodes-th
+    mode, the modes are found with get_common_modes(method='eigh')
+    instead. The iteration stops as soon as the convergence rate of the
+    last step shows that it won't converge in time. The convergence
+    metrics of the last call are kept in info"""
+    _seeds = {}
+
+    def __init__(self, tol=1e-10, maxiter=20, oversample=4, seed=0):
+        self.tol = tol
+        self.maxiter = maxiter
+        self.oversample = oversample
+        self._rng = np.random.RandomState(seed)
+        self.info = {}
+
+    def solve(self, data, nmodes, sel=None, key=None):
+        """Return the nmodes main common modes of data as orthonormal rows.
+        sel is the selection (a boolean mask over all the detectors of
+        the array) that the rows of data come from, to match them with
+        the seed stored under key"""
+        ndet, nfreq = data.shape
+        nmodes = min(nmodes, ndet, nfreq)
+        l = min(nmodes + self.oversample, ndet, nfreq)
+        rows = np.flatnonzero(sel) if sel is not None else np.arange(ndet)
+        if key is not None:
+            key = (key, len(sel) if sel is not None else ndet)
+
+        # start from the seed for the detectors that have one (ncols > 0
+        # columns stored), the rest is random
+        q = self._rng.randn(ndet, l).astype(data.dtype)
+        seed, ncols = self._seeds.get(key, (None, None))
+        seeded = False
+        if seed is not None:
+            ok = ncols[rows] > 0
+            if ok.any():
+                k = min(ncols[rows][ok].min(), l)
+                q[ok, :k] = seed[rows[ok], :k]
+                seeded = True
+        q, _ = np.linalg.qr(q)
+
+        # the angle between successive estimates of the detector gains
+        # can't get much below the precision of the data
+        tol = max(self.tol, 100*np.finfo(data.dtype).eps)
+        u_prev = q[:, :nmodes] if seeded else None
+        angle = np.inf
+        was_slow = False
+        for i in range(self.maxiter):
+            # Rayleigh-Ritz in the current subspace
+            ub, s, v = np.linalg.svd(np.dot(q.T.conjugate(), data),
+                                     full_matrices=False)
+            u = np.dot(q, ub)
+            if u_prev is not None:
+                uk = u[:, :nmodes]
+                angle_prev = angle
+                angle = np.linalg.norm(u_prev - np.dot(uk, np.dot(
+                    uk.T.conjugate(), u_prev)), 2)
+                if angle < tol:
+                    break
+                # give up early if the angle stops decreasing, or if two
+                # steps in a row decrease it too slowly to reach tol
+                # within maxiter iterations
+                rate = angle / angle_prev
+                slow = rate >= 1 or (np.isfinite(rate) and rate > 0 and
+                                     np.log(tol/angle)/np.log(rate) > self.maxiter-i-1)
+                if rate >= 1 or (slow and was_slow):
+                    break
+                was_slow = slow
+            u_prev = u[:, :nmodes]
+            q, _ = np.linalg.qr(np.dot(data, v.T.conjugate()))
+
+        self.info = {
+            'niter': i + 1,
+            'angle': angle,
+            'converged': angle < tol,
+            'seeded': seeded,
+            'fallback': False,
+            's': s[:nmodes],
+        }
+        modes = v[:nmodes]
+        if not self.info['converged']:
+            self.info['fallback'] = True
+            modes = get_common_modes(data, nmodes, method='eigh')
+            u = np.dot(data, modes.T.conjugate())
+            norm = np.linalg.norm(u, axis=0)
+            norm[norm == 0] = 1.
+            u /= norm
+
+        # keep the detector gains of all the Ritz vectors as next seed
+        if key is not None:
+            if seed is None:
+                seed = np.zeros((key[1], l), dtype=np.complex128)
+                ncols = np.zeros(key[1], dtype=int)
+            elif seed.shape[1] < l:
+                seed = np.hstack([seed, np.zeros((key[1], l-seed.shape[1]),
+                                                 dtype=seed.dtype)])
+            seed[rows, :u.shape[1]] = u
+            ncols[rows] = u.shape[1]
+            self._seeds[key] = (seed, ncols)
+        return modes
+
+    @classmethod
+    def clear(cls):
+        cls._seeds = {}
+
+def deproject_modes(data, nmodes, method='eigh', dtype=None, **kwargs):
+    """Remove the nmodes main common modes (see get_common_modes) from
+    data (ndet x nfreq) in place. If dtype is given the modes are found
+    and removed in that precision, e.g. complex128 for complex64 data
+    dominated by the common modes"""
+    x = data if dtype is None else data.astype(dtype, copy=False)
+    modes = get_common_modes(x, nmodes, method, **kwargs)
+    coeff = np.dot(modes, x.T.conj())
+    x -= np.dot(coeff.T.conj(), modes)
+    if x is not data:
+        data[...] = x
+    return data
+
+
+def rebuild_cc(factor, dets=None):
+    """Rebuild the detector correlation matrices (nwin x ndet x ndet)
+    from the low rank factors (ndet x nwin x rank) exported by the LF
+    analysis, optionally for the detectors dets only"""
+    factor = np.asarray(factor)
+    if dets is not None:
+        factor = factor[dets]
+    f = factor.transpose(1, 0, 2)
+    return np.matmul(f, f.conjugate().transpose(0, 2, 1))
+
+
+def cache_block_size(data, block_bytes=2**20):
+    """Number of rows of the 2d array data that fit in block_bytes (at
+    least one), so that a block of rows stays in cache while several
+    operations are applied to it"""
+    row_bytes = data.shape[1]*data.dtype.itemsize
+    return max(1, int(block_bytes // max(row_bytes, 1)))
+
+
+def downsample_rows(data, resample, offset=0, antialias=False, block_size=64,
+                    out=None, transform=None):
+    """Decimate the rows of the c-contiguous 2d array data to their
+    samples offset::resample, block_size rows at a time
+
+    Params:
+        antialias: low-pass filter the rows first with a zero phase
+            polyphase filter (resample_poly), so that sample k is still
+            centered on sample offset+k*resample
+        out: array to write the decimated rows in. If None they are
+            compacted at the start of the memory of data, which is then
+            shrunk in place if nothing else references data, so that no
+            second copy of the samples exists, else the compact rows are
+            copied. Other views of data are invalid afterwards
+        transform: function applied in place to each block of rows before
+            it is decimated
+    """
+    nrows, nsamps = data.shape
+    ncols = len(range(offset, nsamps, resample))
+    if out is None and resample > 1:
+        if not data.flags.c_contiguous:
+            raise ValueError("Can only downsample c-contiguous data in place")
+        flat = data.reshape(-1)
+    block = dec = None
+    for i0 in range(0, nrows, block_size):
+        block = data[i0:i0+block_size]
+        if transform is not None:
+            transform(block)
+        if resample == 1:
+            continue
+        if antialias:
+            dec = resample_poly(block[:, offset:], 1, resample, axis=1)
+        else:
+            dec = block[:, offset::resample]
+        if out is not None:
+            out[i0:i0+len(block)] = dec
+        else:
+            # the rows only move to lower addresses, and the rows after
+            # this block are not overwritten yet
+            flat[i0*ncols:(i0+len(block))*ncols].reshape(len(block), ncols)[:] = dec
+    if out is not None:
+        return out
+    if resample == 1:
+        return data
+    del flat, block, dec
+    if data.flags.owndata:
+        try:
+            data.resize((nrows, ncols))
+            return data
+        except ValueError:
+            # data is referenced elsewhere
+            pass
+    # copy the compact part so that the original samples can be freed
+    return data.reshape(-1)[:nrows*ncols].reshape(nrows, ncols).copy()
+
+
+def detach_data(tod):
+    """Remove the samples from tod and return them, so that the caller
+    holds the only reference to them"""
+    data, tod.data = tod.data, None
+    return data
+
+
+def resample_tod(tod, data, resample, offset=0):
+    """Return tod.copy(resample=resample, resample_offset=offset) with
+    data, the samples offset::resample of tod, already decimated: the
+    metadata (time, pointing, cuts, data mask, ...) is resampled by
+    tod.copy but the samples are not copied"""
+    out = tod.copy(copy_data=False, resample=resample, resample_offset=offset)
+    if out.nsamps != data.shape[1]:
+        raise ValueError("The resampled tod has %d samples, the data %d" % (
+            out.nsamps, data.shape[1]))
+    out.data = data
+    return out
+
+
 def get_sine2_taper(frange, edge_factor = 6):
     # Generate a frequency space taper to reduce ringing in lowFreqAnal
     band = frange[1]-frange[0]
@@ -170,3 +654,602 @@ def get_time_domain_modes(fmodes, n_l, nsamps, df=1.,):
     modes_dt = 1./modes.shape[1]/df
     modes *= np.sqrt(2.*fmodes.shape[1]/nsamps)
     return modes, modes_dt
+
+
+def get_moments(x, axis=-1, overwrite_x=False, chunk_size=1024):
+    """Mean and second to fourth central moments of x along an axis. The
+    powers of the deviations are accumulated chunk_size samples at a
+    time, so that the temporaries stay small. With overwrite_x, x is
+    centered in place instead of in a copy"""
+    mean = np.mean(x, axis=axis, keepdims=True)
+    if overwrite_x:
+        x -= mean
+        d = x
+    else:
+        d = x - mean
+    d = np.moveaxis(d, axis, -1)
+    n = d.shape[-1]
+    m2, m3, m4 = [np.zeros(d.shape[:-1], dtype=d.dtype) for i in range(3)]
+    d2 = np.empty(d.shape[:-1] + (min(chunk_size, n),), dtype=d.dtype)
+    dk = np.empty_like(d2)
+    for i in range(0, n, chunk_size):
+        c = d[..., i:i+chunk_size]
+        w = c.shape[-1]
+        np.multiply(c, c, out=d2[..., :w])
+        m2 += np.sum(d2[..., :w], axis=-1)
+        m3 += np.sum(np.multiply(d2[..., :w], c, out=dk[..., :w]), axis=-1)
+        m4 += np.sum(np.multiply(d2[..., :w], d2[..., :w], out=dk[..., :w]), axis=-1)
+    return np.squeeze(mean, axis=axis), m2/n, m3/n, m4/n
+
+
+def skewtest_moments(n, mean, m2, m3):
+    """Same as scipy.stats.skewtest for samples of size n with the given
+    mean and central moments, returns (Z, pvalue)"""
+    n = float(n) if n >= 8 else np.nan
+    with np.errstate(all='ignore'):
+        zero = m2 <= (np.finfo(m2.dtype).eps * mean)**2
+        b2 = np.where(zero, np.nan, m3 / m2**1.5)
+        y = b2 * np.sqrt(((n + 1) * (n + 3)) / (6.0 * (n - 2)))
+        beta2 = (3.0 * (n**2 + 27*n - 70) * (n+1) * (n+3) /
+                 ((n-2.0) * (n+5) * (n+7) * (n+9)))
+        W2 = -1 + np.sqrt(2 * (beta2 - 1))
+        delta = 1 / np.sqrt(0.5 * np.log(W2))
+        alpha = np.sqrt(2.0 / (W2 - 1))
+        y = np.where(y == 0, 1., y)
+        Z = delta * np.log(y / alpha + np.sqrt((y / alpha)**2 + 1))
+    return Z, 2*special.ndtr(-np.abs(Z))
+
+
+def kurtosistest_moments(n, mean, m2, m4):
+    """Same as scipy.stats.kurtosistest for samples of size n with the
+    given mean and central moments, returns (Z, pvalue)"""
+    n = float(n) if n >= 5 else np.nan
+    with np.errstate(all='ignore'):
+        zero = m2 <= (np.finfo(m2.dtype).eps * mean)**2
+        b2 = np.where(zero, np.nan, m4 / m2**2.0)
+        E = 3.0*(n-1) / (n+1)
+        varb2 = 24.0*n*(n-2)*(n-3) / ((n+1)*(n+1.)*(n+3)*(n+5))
+        x = (b2-E) / varb2**0.5
+        sqrtbeta1 = 6.0*(n*n-5*n+2)/((n+7)*(n+9)) * ((6.0*(n+3)*(n+5))
+                                                     / (n*(n-2)*(n-3)))**0.5
+        A = 6.0 + 8.0/sqrtbeta1 * (2.0/sqrtbeta1 + (1+4.0/(sqrtbeta1**2))**0.5)
+        term1 = 1 - 2/(9.0*A)
+        denom = 1 + x * (2/(A-4.0))**0.5
+        term2 = np.sign(denom) * np.where(denom == 0.0, np.nan,
+                                          ((1-2.0/A)/np.abs(denom))**(1/3.))
+        Z = (term1 - term2) / (2/(9.0*A))**0.5
+    return Z, 2*special.ndtr(-np.abs(Z))
+
+
+def get_hf_stats(hf_data, nsamps, segments=None, block_size=64, pool=None,
+                 workers=1, backend='scipy'):
+    """Skewness and kurtosis tests of the time-domain signal of each
+    detector given by its fourior modes hf_data (ndet x nbins), the same
+    signal as get_time_domain_modes(hf_data, 1, nsamps), computed
+    block_size detectors at a time so that the full signal is never
+    stored. If segments = (starts, length) is given, the std and the
+    tests over the segments [start, start+length) of the signal are also
+    returned, computed for all the segments of a block at once. Returns a dict of arrays with
+    the detectors along the first axis. complex64 data are analyzed in
+    single precision"""
+    ndet, nbins = hf_data.shape
+    n = 2*nbins
+    res = {k: np.zeros(ndet) for k in ['skew', 'skewp', 'kurt', 'kurtp']}
+    fit = np.zeros(0, dtype=int)
+    if segments is not None:
+        # segments that don't fit in the signal are left as nan
+        starts, length = segments
+        starts = np.asarray(starts, dtype=int)
+        for k in ['prms', 'pskew', 'pskewp', 'pkurt', 'pkurtp']:
+            res[k] = np.full((ndet, len(starts)), np.nan)
+        if length > 0:
+            fit = np.flatnonzero((starts >= 0) * (starts + length <= n))
+    if pool is None:
+        pool = BufferPool()
+    # single precision data are analyzed in single precision
+    if hf_data.dtype == np.complex64:
+        ctype, rtype = np.complex64, np.float32
+    else:
+        ctype, rtype = np.complex128, np.float64
+    for i in range(0, ndet, block_size):
+        nb = min(block_size, ndet - i)
+        # the signal of the band shifted to start at the first bin
+        fcm = pool.get('hf_fcm', (nb, nbins+1), ctype)
+        fcm[:, 0] = 0
+        fcm[:, 1:-1] = hf_data[i:i+nb, :-1]
+        fcm[:, -1] = np.real(hf_data[i:i+nb, -1])
+        x = irfft(fcm, n, workers=workers, backend=backend,
+                  overwrite_x=True).astype(rtype, copy=False)
+        x *= np.sqrt(2.*nbins/nsamps)
+
+        # the central moments are shift invariant, so x can be centered
+        # in place before the segments are analyzed
+        mean, m2, m3, m4 = get_moments(x, overwrite_x=True)
+        shift = mean
+        res['skew'][i:i+nb], res['skewp'][i:i+nb] = skewtest_moments(n, mean, m2, m3)
+        res['kurt'][i:i+nb], res['kurtp'][i:i+nb] = kurtosistest_moments(n, mean, m2, m4)
+
+        if len(fit) > 0:
+            # gather all the segments at once (nb x nseg x length)
+            seg = x[:, starts[fit, np.newaxis] + np.arange(length)]
+            mean, m2, m3, m4 = get_moments(seg, overwrite_x=True)
+            mean += shift[:, np.newaxis]
+            res['prms'][i:i+nb, fit] = np.sqrt(m2)
+            res['pskew'][i:i+nb, fit], res['pskewp'][i:i+nb, fit] = \
+                skewtest_moments(length, mean, m2, m3)
+            res['pkurt'][i:i+nb, fit], res['pkurtp'][i:i+nb, fit] = \
+                kurtosistest_moments(length, mean, m2, m4)
+    return res
+
+
+def get_detector_stats(data, block_bytes=2**20, block_size=None,
+                       zero_stride=100, windows=()):
+    """Compute simple statistics of each detector (row of data) in blocks
+    of block_bytes (or block_size detectors if given), small enough to
+    stay in cache. Each block is read from memory once, the statistics
+    are then reduced from the cached block, with the deviations from the
+    mean computed in one reused buffer. The results are the same as the
+    corresponding numpy calls on the full data
+
+    Params:
+        zero_stride: the zero check only looks at every zero_stride-th
+            sample
+        windows: lengths n of the head / tail windows, for each one the
+            mean difference between the first and last n samples is stored
+            in head_tail[n]
+    """
+    ndet = data.shape[0]
+    if block_size is None:
+        block_size = cache_block_size(data, block_bytes)
+    stats = {
+        'mean': np.empty(ndet, dtype=data.dtype),
+        'var': np.empty(ndet, dtype=data.dtype),
+        'std': np.empty(ndet, dtype=data.dtype),
+        'min': np.empty(ndet, dtype=data.dtype),
+        'max': np.empty(ndet, dtype=data.dtype),
+        'zero': np.empty(ndet, dtype=bool),
+        'head_tail': dict((n, np.empty(ndet, dtype=data.dtype)) for n in windows),
+    }
+    dev = np.empty((min(block_size, ndet),) + data.shape[1:], dtype=data.dtype)
+    for i0 in range(0, ndet, block_size):
+        block = data[i0:i0+block_size]
+        i1 = i0 + len(block)
+        mean = np.mean(block, axis=1, keepdims=True)
+        stats['mean'][i0:i1] = mean[:, 0]
+        # the same steps as np.var
+        d = np.subtract(block, mean, out=dev[:len(block)])
+        stats['var'][i0:i1] = np.mean(np.square(d, out=d), axis=1)
+        stats['min'][i0:i1] = np.min(block, axis=1)
+        stats['max'][i0:i1] = np.max(block, axis=1)
+        stats['zero'][i0:i1] = ~block[:, ::zero_stride].any(axis=1)
+        for n in windows:
+            stats['head_tail'][n][i0:i1] = np.mean(block[:, :n]-block[:, -n:], axis=1)
+    stats['std'][:] = np.sqrt(stats['var'])
+    stats['constant'] = stats['min'] == stats['max']
+    return stats
+
+
+def merge_bands(bands, nbins=None):
+    """Sort a list of [n_l, n_h) index ranges and merge the ones that
+    overlap or touch. A stop of None means up to nbins"""
+    bands = sorted([(int(l), nbins if h is None else int(h)) for l, h in bands])
+    merged = []
+    for l, h in bands:
+        if nbins is not None:
+            l, h = max(l, 0), min(h, nbins)
+        if h <= l:
+            continue
+        if merged and l <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], h)
+        else:
+            merged.append([l, h])
+    return [tuple(b) for b in merged]
+
+
+def get_freq_bins(sources, df, nbins=None):
+    """Collect the frequency index ranges needed by a list of sources.
+    A source is either a routine that declares the ranges it reads
+    through a freq_bins(df) method, or a (fmin, fmax) tuple in Hz"""
+    bins = []
+    for src in sources:
+        if hasattr(src, 'freq_bins'):
+            bins.extend(src.freq_bins(df))
+        else:
+            fmin, fmax = src
+            bins.append((int(np.floor(fmin/df)), int(np.ceil(fmax/df))+1))
+    return merge_bands(bins, nbins)
+
+
+def divisors(n):
+    """Sorted divisors of n"""
+    small = [d for d in range(1, int(np.sqrt(n))+1) if n % d == 0]
+    return sorted(set(small + [n//d for d in small]))
+
+
+class BandDecimator(object):
+    """Computes the rfft bins [n_l, n_h) of real data zero-padded to nf
+    samples, i.e. rfft(data, nf)[:, n_l:n_h], by decimate-then-fft: the
+    band is mixed down to around zero frequency, low-pass filtered,
+    decimated by D and transformed with a short fft of M = nf/D points,
+    which has the same df as the full transform. The band is centered on
+    a multiple of M, so that the mixing folds into the polyphase filter
+    and the data stays real. The filter is a Kaiser windowed sinc of
+    2*half_taps*D+1 taps, applied circularly on the nf samples so that
+    its response H is known exactly and divided out, what is left is the
+    aliasing through the stopband (about -150 dB with the defaults). The
+    filter runs in double precision. Each band costs about half of a
+    double precision rfft of the data whatever its width, so this only
+    pays off for one or two narrow bands"""
+    def __init__(self, nf, n_l, n_h, half_taps=16, beta=16.):
+        self.nf = nf
+        self.bins = (n_l, n_h)
+        # width of the transition band in units of M
+        atten = beta/0.1102 + 8.7
+        trans = (atten - 7.95) / (14.36 * 2*half_taps)
+        # largest decimation that keeps the band in the passband
+        self.D, self.M, self.center = 1, nf, 0
+        for M in divisors(nf):
+            center = int(np.round((n_l + n_h - 1) / 2. / M)) * M
+            if max(center - n_l, n_h - 1 - center) <= (0.5 - trans/2.) * M:
+                self.D, self.M, self.center = nf // M, M, center
+                break
+        D, K = self.D, half_taps
+        t = np.arange(-K*D, K*D+1)
+        h = np.sinc(t/D) / D * np.kaiser(len(t), beta)
+        # response of the filter centered on zero, real and even
+        H = np.fft.rfft(np.roll(np.r_[h, np.zeros(nf - len(h))], -K*D)).real
+        j = np.arange(n_l, n_h) - self.center
+        self._H = H[np.abs(j)]
+        self._j = j % self.M
+        # filter with the mixing folded in, split into its polyphase
+        # components: tap t = a*D - d acts on phase d of row m - a
+        hc = h * np.exp(2j*np.pi*(self.center//self.M)*t/D)
+        self._shifts = np.arange(-K, K+1)
+        tt = self._shifts[np.newaxis, :]*D - np.arange(D)[:, np.newaxis]
+        G = np.where(abs(tt) <= K*D, hc[np.clip(tt + K*D, 0, len(t)-1)], 0)
+        self._G = np.ascontiguousarray(np.concatenate([G.real, G.imag], axis=1).T)
+
+    @property
+    def narrow(self):
+        """Whether the band is narrow enough for the decimation, i.e. the
+        intermediate filter outputs are smaller than the data"""
+        return self.D >= 4*len(self._shifts)
+
+    def __call__(self, data, workers=1, backend='scipy'):
+        """The bins of the rows of data (ndet x nsamps, nsamps <= nf)"""
+        nrows, nsamps = data.shape
+        D, M, K = self.D, self.M, (len(self._shifts) - 1)//2
+        R = -(-nsamps // D)
+        x = np.zeros((nrows, R*D))
+        x[:, :nsamps] = data
+        # the filter outputs of each tap, real then imaginary parts
+        na = len(self._shifts)
+        W = np.dot(self._G, x.reshape(nrows*R, D).T).reshape(2, na, nrows, R)
+        del x
+        # sum the taps at their shifts, and wrap the ends around
+        acc = np.zeros((2, nrows, M + 2*K))
+        for i, a in enumerate(self._shifts):
+            acc[:, :, K+a:K+a+R] += W[:, i]
+        acc[:, :, K:2*K] += acc[:, :, K+M:]
+        acc[:, :, M:M+K] += acc[:, :, :K]
+        z = acc[0, :, K:K+M] + 1j*acc[1, :, K:K+M]
+        del W, acc
+        Z = fft(z, workers=workers, backend=backend, overwrite_x=True)
+        return D * Z[:, self._j] / self._H
+
+
+class BandedSpectrum(object):
+    """Keeps only a few frequency bands of a spectrum (ndet x nbins)
+    instead of the full array. It answers the fdata[sel, n_l:n_h] type
+    of queries of the analysis routines as long as [n_l, n_h) falls
+    into one of the bands kept"""
+    def __init__(self, bands, data, nbins):
+        self.bands = [tuple(b) for b in bands]
+        self.data = list(data)
+        self.shape = (self.data[0].shape[0], nbins)
+        self.dtype = self.data[0].dtype
+        self.ndim = 2
+
+    @classmethod
+    def from_tod_data(cls, data, nf, bands, dtype=np.complex128,
+                      block_size=64, pool=None, engine='rfft', **kwargs):
+        """Compute the given bands of the rfft of data (zero-padded to nf
+        samples) block_size detectors at a time, so that only one block
+        of the full spectrum is held in memory. With engine='decimate'
+        the bands are computed with BandDecimator instead if they are all
+        narrow enough, otherwise the full rfft is needed anyway and they
+        are sliced out of it. The arrays are taken from pool if a
+        BufferPool is given. Other keyword arguments (workers, backend)
+        are passed to rfft and BandDecimator"""
+        if engine not in ('rfft', 'decimate'):
+            raise ValueError("Unknown engine %s" % engine)
+        nbins = nf//2+1
+        bands = merge_bands(bands, nbins)
+        if len(bands) == 0:
+            raise ValueError("no frequency band to keep")
+        ndet = data.shape[0]
+        if pool is None:
+            pool = BufferPool()
+        fdata = [pool.get('band%d' % i, (ndet, h-l), dtype)
+                 for i, (l, h) in enumerate(bands)]
+        decimators = [None] * len(bands)
+        if engine == 'decimate':
+            decimators = [BandDecimator(nf, l, h) for l, h in bands]
+            if not all([dec.narrow for dec in decimators]):
+                decimators = [None] * len(bands)
+        full = decimators[0] is None
+        if full:
+            buf = pool.get('block', (min(block_size, ndet), nbins), dtype)
+        for i in range(0, ndet, block_size):
+            block = data[i:i+block_size]
+            if full:
+                spec = rfft(block, nf, out=buf[:len(block)],
+                            block_size=block_size, **kwargs)
+            for (l, h), d, dec in zip(bands, fdata, decimators):
+                if dec is not None:
+                    d[i:i+block_size] = dec(block, **kwargs)
+                else:
+                    d[i:i+block_size] = spec[:, l:h]
+        return cls(bands, fdata, nbins)
+
+    @property
+    def nbytes(self):
+        return sum([d.nbytes for d in self.data])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def get_band(self, n_l, n_h):
+        """Return the data of the band that contains [n_l, n_h) and the
+        index of its first frequency"""
+        for (l, h), d in zip(self.bands, self.data):
+            if l <= n_l and n_h <= h:
+                return d, l
+        raise IndexError("freqs [%d, %d) are not kept in the spectrum, kept "
+                         "bands are %s" % (n_l, n_h, self.bands))
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) != 2 or \
+           not isinstance(key[1], slice) or key[1].step not in (None, 1):
+            raise IndexError("only fdata[dets, n_l:n_h] queries are supported")
+        sel, freqs = key
+        n_l, n_h, _ = freqs.indices(self.shape[1])
+        d, l = self.get_band(n_l, n_h)
+        return d[sel, n_l-l:n_h-l]
+
+
+class BandPowerIndex(object):
+    """Cumulative sums of |fdata|**power along the frequency axis (power
+    spectrum by default, amplitude with power=1), built once so that the
+    sum or mean over any band [n_l, n_h) is answered for all detectors
+    with one subtraction. Works on arrays and on BandedSpectrum, in which
+    case a query has to fall in one of the kept bands. If bands (a list
+    of [n_l, n_h) index ranges) is given, only these are indexed"""
+    def __init__(self, fdata, df=1., power=2, block_size=64, bands=None):
+        self.df = df
+        if bands is not None:
+            bands = merge_bands(bands, fdata.shape[1])
+            data = [fdata[:, l:h] for l, h in bands]
+        elif isinstance(fdata, BandedSpectrum):
+            bands, data = fdata.bands, fdata.data
+        else:
+            bands, data = [(0, fdata.shape[1])], [fdata]
+        self.bands = bands
+        self._cums = []
+        for (l, h), d in zip(bands, data):
+            cum = np.zeros((d.shape[0], h-l+1))
+            for i in range(0, d.shape[0], block_size):
+                np.cumsum(np.abs(d[i:i+block_size])**power, axis=1,
+                          out=cum[i:i+block_size, 1:])
+            self._cums.append(cum)
+
+    def sum(self, n_l, n_h):
+        """Sum over the frequency indices [n_l, n_h) for each detector"""
+        for (l, h), cum in zip(self.bands, self._cums):
+            if l <= n_l and n_h <= h:
+                return cum[:, n_h-l] - cum[:, n_l-l]
+        raise IndexError("freqs [%d, %d) are not in the index, indexed "
+                         "bands are %s" % (n_l, n_h, self.bands))
+
+    def mean(self, n_l, n_h):
+        """Mean over the frequency indices [n_l, n_h) for each detector"""
+        return self.sum(n_l, n_h) / (n_h - n_l)
+
+    def band_mean(self, fmin, fmax):
+        """Mean over the frequencies [fmin, fmax) in Hz"""
+        return self.mean(int(round(fmin/self.df)), int(round(fmax/self.df)))
+
+
+class BufferPool(object):
+    """Keeps named buffers alive from one TOD to the next so that arrays
+    of the same (or smaller) size reuse the memory instead of being
+    reallocated. A buffer is only valid until the next get with the
+    same name"""
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, name, shape, dtype):
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        buf = self._buffers.get(name, None)
+        if buf is None or buf.dtype != dtype or buf.size < size:
+            buf = np.empty(size, dtype=dtype)
+            self._buffers[name] = buf
+        return buf[:size].reshape(shape)
+
+    def clear(self):
+        self._buffers = {}
+
+
+def get_band_data(fdata, sel, n_l, n_h, pool=None, name='band_data'):
+    """Same as fdata[sel, n_l:n_h] (a copy) for an array or a
+    BandedSpectrum. If a BufferPool is given the copy is written in
+    its buffer of the given name instead of a new array"""
+    if pool is None:
+        return fdata[sel, n_l:n_h]
+    if isinstance(fdata, BandedSpectrum):
+        d, l = fdata.get_band(n_l, n_h)
+        src = d[:, n_l-l:n_h-l]
+    else:
+        src = fdata[:, n_l:n_h]
+    idx = np.flatnonzero(sel) if np.asarray(sel).dtype == bool else sel
+    out = pool.get(name, (len(idx), n_h-n_l), src.dtype)
+    np.take(src, idx, axis=0, out=out)
+    return out
+
+
+def get_lf_stacks(fdata, sel, windows, pool=None, name='lf_data'):
+    """Gather the data of the selected detectors in the union of the
+    (overlapping) windows once and stack the windows of equal width.
+    Returns a list of (iwin, stack) with iwin the indices of the windows
+    in the stack, which has the shape (len(iwin), nsel, width)"""
+    n_min = min([n_l for n_l, n_h in windows])
+    n_max = max([n_h for n_l, n_h in windows])
+    union = get_band_data(fdata, sel, n_min, n_max, pool=pool,
+                          name=name+'_union')
+    groups = {}
+    for i, (n_l, n_h) in enumerate(windows):
+        groups.setdefault(n_h - n_l, []).append(i)
+    stacks = []
+    for width in sorted(groups):
+        iwin = groups[width]
+        shape = (len(iwin), union.shape[0], width)
+        if pool is None:
+            stack = np.empty(shape, dtype=union.dtype)
+        else:
+            stack = pool.get('%s_%d' % (name, width), shape, union.dtype)
+        for j, i in enumerate(iwin):
+            n_l = windows[i][0] - n_min
+            stack[j] = union[:, n_l:n_l+width]
+        stacks.append((iwin, stack))
+    return stacks
+
+
+def sel_mean(data, sel):
+    """Mean of data (nwin x ndet) over the first axis for the selected
+    detectors and 0 for the others, the same as
+    numpy.ma.MaskedArray(data, mask).mean(axis=0).data with the mask
+    ~sel in every row"""
+    res = np.sum(data, axis=0) * 1. / len(data)
+    res[~np.asarray(sel, dtype=bool)] = 0.
+    return res
+
+
+def sel_max(data, sel):
+    """Max of data (nwin x ndet) over the first axis for the selected
+    detectors, like sel_mean but the others get the numpy.ma default
+    fill value 1e20"""
+    res = np.max(data, axis=0)
+    res[~np.asarray(sel, dtype=bool)] = 1e20
+    return res
+
+
+class SubsetStore(dict):
+    """Minimal stand-in for the data store, used to rerun routines on a
+    subset of the detectors"""
+    def set(self, key, value):
+        self[key] = value
+
+
+def subset_tod(tod, idx):
+    """Shallow copy of a tod restricted to the detectors idx"""
+    sub = copy.copy(tod)
+    sub.data = tod.data[idx]
+    sub.info = copy.copy(tod.info)
+    sub.info.det_uid = np.asarray(tod.info.det_uid)[idx]
+    array_data = getattr(tod.info, 'array_data', None)
+    if array_data is not None:
+        sub.info.array_data = dict([(k, np.asarray(v)[idx])
+                                    for k, v in array_data.items()])
+    return sub
+
+
+def subset_dets(value, idx, ndet):
+    """Restrict the per-detector arrays (of length ndet) of a data store
+    entry, or of the entries of a dictionary, to the detectors idx"""
+    if isinstance(value, dict):
+        return dict([(k, subset_dets(v, idx, ndet)) for k, v in value.items()])
+    if isinstance(value, np.ndarray) and value.ndim > 0 and len(value) == ndet:
+        return value[idx]
+    return value
+
+
+def max_rel_deviation(a, b):
+    """Largest absolute deviation of a from b relative to the largest
+    absolute value in b, ignoring non-finite entries and the 1e20 fill
+    values of unselected detectors"""
+    a = np.asarray(a, dtype=float).ravel()
+    b = np.asarray(b, dtype=float).ravel()
+    ok = np.isfinite(a) * np.isfinite(b) * (np.abs(b) < 1e20)
+    if not np.any(ok):
+        return 0.
+    scale = np.abs(b[ok]).max()
+    dev = np.abs(a[ok] - b[ok]).max()
+    return dev / scale if scale > 0 else dev
+
+
+def spectrum_cache_key(name, params=None):
+    """Build the cache key of a TOD spectrum from the TOD name and a
+    hash of the parameters that determine it (upstream preprocessing
+    and fft settings)"""
+    params = json.dumps(params, sort_keys=True, default=str)
+    digest = hashlib.sha1(params.encode('utf-8')).hexdigest()[:16]
+    return "%s.%s" % (name, digest)
+
+
+def save_spectrum(path, fft_data):
+    """Save fft data to a directory so that it can be memory-mapped
+    back with load_spectrum. Arrays are stored as .npy files and
+    scalars in a json file. The directory is written under a temporary
+    name and renamed in the end so an interrupted write never leaves a
+    partial cache entry behind"""
+    tmp = "%s.tmp%d" % (path, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    meta = {}
+    for k, v in fft_data.items():
+        if isinstance(v, BandedSpectrum):
+            meta['%s_bands' % k] = v.bands
+            meta['%s_nbins' % k] = v.shape[1]
+            for i, d in enumerate(v.data):
+                np.save(os.path.join(tmp, "%s.%d.npy" % (k, i)), d)
+        elif np.isscalar(v):
+            meta[k] = v.item() if isinstance(v, np.generic) else v
+        else:
+            np.save(os.path.join(tmp, "%s.npy" % k), np.asarray(v))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    # another process may have written the same entry in the mean time,
+    # also between the check and the rename
+    if os.path.exists(path):
+        shutil.rmtree(tmp)
+        return
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)
+        if not os.path.exists(path):
+            raise
+
+
+def load_spectrum(path, mmap_mode='r'):
+    """Load fft data saved by save_spectrum. The arrays are memory-mapped
+    (read-only by default) instead of read into memory. Returns None if
+    there is no cache entry at path"""
+    meta_file = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_file):
+        return None
+    with open(meta_file, "r") as f:
+        fft_data = json.load(f)
+    for fname in os.listdir(path):
+        if fname.endswith(".npy") and fname.count(".") == 1:
+            fft_data[fname[:-4]] = np.load(os.path.join(path, fname),
+                                           mmap_mode=mmap_mode)
+    # reassemble banded spectra
+    for k in [k[:-6] for k in list(fft_data.keys()) if k.endswith('_bands')]:
+        bands = fft_data.pop('%s_bands' % k)
+        data = [np.load(os.path.join(path, "%s.%d.npy" % (k, i)),
+                        mmap_mode=mmap_mode) for i in range(len(bands))]
+        fft_data[k] = BandedSpectrum(bands, data, fft_data.pop('%s_nbins' % k))
+    return fft_data